@@ -0,0 +1,146 @@
+import asyncio
+import random
+import threading
+import time
+
+import metrics
+from caches import LRUCache
+
+
+# ==============================================================================
+# 1. TOKEN BUCKETS
+# ==============================================================================
+class TokenBucket:
+    """Refills at `rate` tokens per second up to `capacity`. reserve() always
+    takes a token, going into debt if necessary, and returns how long the
+    caller has to wait for it; callers are therefore served in arrival order."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def refund(self):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + 1)
+
+    def remaining(self):
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+# ==============================================================================
+# 2. RATE-LIMITED GATEWAY
+# ==============================================================================
+class QuotaExceeded(Exception):
+    def __init__(self, name):
+        self.name = name
+        super().__init__(f"{name} API budget exhausted")
+
+
+class ApiGateway:
+    """Every call to one Google API goes through here: a global bucket keeps the
+    whole project under quota, per-user buckets stop one user from eating it,
+    and rate-limit or server errors are retried with jittered backoff.
+
+    classify(error) returns 'rate_limited', another retry reason, or None for
+    errors that must not be retried. Rate limits mean the request was refused,
+    so they are retried for every call; 5xx and network errors may arrive after
+    Google already acted, so callers of non-idempotent methods pass
+    retry_server_errors=False."""
+
+    def __init__(self, name, classify, global_rate, global_burst, user_rate, user_burst,
+                 max_wait, max_retries, backoff_base, backoff_max, max_users=10000):
+        self.name = name
+        self.classify = classify
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._user_buckets = LRUCache(max_users)
+        self._lock = threading.Lock()
+
+    def _user_bucket(self, user_id):
+        key = int(user_id)
+        bucket = self._user_buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self._user_buckets.get(key)
+                if bucket is None:
+                    bucket = TokenBucket(self.user_rate, self.user_burst)
+                    self._user_buckets.put(key, bucket)
+        return bucket
+
+    def _reserve(self, user_id):
+        buckets = [self.global_bucket]
+        if user_id is not None:
+            buckets.append(self._user_bucket(user_id))
+        wait = max(bucket.reserve() for bucket in buckets)
+        if wait > self.max_wait:
+            # Queueing this long would only turn into a Discord timeout; fail fast.
+            for bucket in buckets:
+                bucket.refund()
+            metrics.api_rejected_total.inc((self.name,))
+            raise QuotaExceeded(self.name)
+        if wait:
+            metrics.api_throttled_seconds_total.inc((self.name,), wait)
+        return wait
+
+    def _retry_delay(self, error, attempt, retry_server_errors):
+        # Returns the backoff before the next attempt, or raises if there is none.
+        reason = self.classify(error)
+        if reason is None or (reason != 'rate_limited' and not retry_server_errors):
+            raise error
+        if attempt == self.max_retries:
+            if reason == 'rate_limited':
+                raise QuotaExceeded(self.name) from error
+            raise error
+        metrics.api_retries_total.inc((self.name, reason))
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def call(self, user_id, func, retry_server_errors=True):
+        # func is a coroutine function; it is called again on every retry.
+        for attempt in range(self.max_retries + 1):
+            wait = self._reserve(user_id)
+            if wait:
+                await asyncio.sleep(wait)
+            try:
+                return await func()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, retry_server_errors)
+            await asyncio.sleep(delay)
+
+    def call_sync(self, user_id, func, retry_server_errors=True):
+        # For worker threads and Flask routes.
+        for attempt in range(self.max_retries + 1):
+            wait = self._reserve(user_id)
+            if wait:
+                time.sleep(wait)
+            try:
+                return func()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, retry_server_errors)
+            time.sleep(delay)
+
+    def stats(self):
+        return {
+            'remaining': self.global_bucket.remaining(),
+            'capacity': self.global_bucket.capacity,
+            'users': len(self._user_buckets),
+        }
@@ -0,0 +1,79 @@
+"""Micro-benchmarks for /addevent date parsing.
+
+Compares, over a corpus of phrases users actually type:
+  baseline  - dateparser.parse(text) with default settings (the old path)
+  uncached  - dateparsing fast paths + restricted-language parser, memo cleared
+  memoized  - dateparsing.parse_when with a warm memo (same time bucket)
+
+Run from the repository root: python benchmarks/bench_dateparse.py
+"""
+import datetime
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dateparser  # noqa: E402
+
+import dateparsing  # noqa: E402
+
+ROUNDS = int(os.environ.get('BENCH_ROUNDS', '20'))
+
+CORPUS = [
+    'tomorrow at 3pm',
+    'tomorrow at 10am',
+    'today at 5:30 pm',
+    'tomorrow 9:00',
+    '3pm',
+    '14:00',
+    '2030-03-14',
+    '2030-03-14T09:30:00',
+    '2030-03-14 18:45',
+    'next monday at 9am',
+    'friday at noon',
+    'in 2 hours',
+    'in 30 minutes',
+    'march 3rd at 7pm',
+    '25 december 2030 18:00',
+    'tomorrow evening',
+]
+
+
+def time_corpus(func, before_each_round=None):
+    samples = []
+    for _ in range(ROUNDS):
+        if before_each_round:
+            before_each_round()
+        for phrase in CORPUS:
+            started = time.perf_counter()
+            func(phrase)
+            samples.append((time.perf_counter() - started) * 1_000_000)
+    return samples
+
+
+def report(label, samples):
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{label:<9} mean={statistics.mean(samples):10.1f} us  p50={statistics.median(samples):10.1f} us  p95={p95:10.1f} us")
+
+
+def main():
+    started = time.perf_counter()
+    dateparser.parse('warm up')
+    print(f"first dateparser call: {(time.perf_counter() - started) * 1000:.1f} ms")
+    dateparsing.warm_up()
+
+    fast = sum(1 for phrase in CORPUS if dateparsing.parse_fast(dateparsing._normalize(phrase), datetime.datetime.now()))
+    print(f"fast-path coverage: {fast}/{len(CORPUS)} phrases")
+
+    report('baseline', time_corpus(dateparser.parse))
+    report('uncached', time_corpus(dateparsing.parse_when, dateparsing._parse_in_bucket.cache_clear))
+    dateparsing._parse_in_bucket.cache_clear()
+    report('memoized', time_corpus(dateparsing.parse_when))
+    print(f"memo: {dateparsing.cache_stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Bytes on the wire and client parse time for an events.list page.
+
+Compares, on a synthetic calendar whose events carry long descriptions,
+attendee lists and conference data:
+  full       - the complete event resources, uncompressed (the old request)
+  full+gzip  - complete resources, gzip-encoded
+  fields     - calendar_api.EVENT_LIST_FIELDS projection, uncompressed
+  fields+gzip - the projection, gzip-encoded (what the bot requests now)
+
+The projection is applied locally the way Google applies `fields=`, so no
+network access is needed. Parse time covers gunzip (where used) + json.loads.
+
+Run from the repository root: python benchmarks/bench_partial_response.py
+"""
+import datetime
+import gzip
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import calendar_api  # noqa: E402
+
+PAGE_SIZE = int(os.environ.get('BENCH_PAGE_SIZE', '250'))
+ROUNDS = int(os.environ.get('BENCH_ROUNDS', '50'))
+WORDS = ('roadmap', 'review', 'owners', 'issues', 'budget', 'launch', 'metrics', 'hiring', 'design', 'risks',
+         'customer', 'follow-up', 'timeline', 'staffing', 'migration', 'incident', 'quarterly', 'demo')
+
+
+def make_event(index, start, rng):
+    end = start + datetime.timedelta(hours=1)
+    attendees = [
+        {
+            'email': f'person{n}@example.com', 'displayName': f'Person {n}',
+            'responseStatus': 'accepted' if n % 3 else 'needsAction', 'optional': n % 5 == 0,
+        }
+        for n in range(30)
+    ]
+    return {
+        'kind': 'calendar#event',
+        'etag': f'"{3_400_000_000_000_000 + index}"',
+        'id': f'event{index:06d}',
+        'status': 'confirmed',
+        'htmlLink': f'https://www.google.com/calendar/event?eid=event{index:06d}',
+        'created': '2030-01-01T09:00:00.000Z',
+        'updated': '2030-01-02T09:00:00.000Z',
+        'summary': f'Planning session #{index}',
+        'description': ' '.join(rng.choice(WORDS) for _ in range(300)),
+        'location': 'Conference room 4B, Building 2',
+        'creator': {'email': 'organizer@example.com'},
+        'organizer': {'email': 'organizer@example.com', 'displayName': 'Organizer'},
+        'start': {'dateTime': start.isoformat(), 'timeZone': 'UTC'},
+        'end': {'dateTime': end.isoformat(), 'timeZone': 'UTC'},
+        'iCalUID': f'event{index:06d}@google.com',
+        'sequence': 2,
+        'attendees': attendees,
+        'hangoutLink': f'https://meet.google.com/abc-defg-{index:03d}',
+        'conferenceData': {
+            'entryPoints': [
+                {'entryPointType': 'video', 'uri': f'https://meet.google.com/abc-defg-{index:03d}', 'label': 'meet'},
+                {'entryPointType': 'phone', 'uri': 'tel:+1-555-0100', 'label': '+1 555-0100', 'pin': '123456'},
+            ],
+            'conferenceSolution': {'key': {'type': 'hangoutsMeet'}, 'name': 'Google Meet'},
+            'conferenceId': f'abc-defg-{index:03d}',
+        },
+        'reminders': {'useDefault': True},
+        'eventType': 'default',
+    }
+
+
+def make_page():
+    start = datetime.datetime(2030, 1, 1, 9, tzinfo=datetime.timezone.utc)
+    rng = random.Random(42)
+    return {
+        'kind': 'calendar#events',
+        'etag': '"p33c"',
+        'summary': 'organizer@example.com',
+        'updated': '2030-01-02T09:00:00.000Z',
+        'timeZone': 'UTC',
+        'accessRole': 'owner',
+        'items': [make_event(i, start + datetime.timedelta(hours=i), rng) for i in range(PAGE_SIZE)],
+        'nextSyncToken': 'CPDAlvWDx70CEPDAlvWDx70CGAU=',
+    }
+
+
+def parse_mask(mask):
+    # "items(id,start),nextPageToken" -> {'items': {'id': None, 'start': None}, 'nextPageToken': None}
+    def parse(pos):
+        fields, name = {}, ''
+        while pos < len(mask):
+            char = mask[pos]
+            if char == '(':
+                fields[name], pos = parse(pos + 1)
+                name = ''
+            elif char == ')':
+                break
+            elif char == ',':
+                if name:
+                    fields[name] = None
+                name = ''
+            else:
+                name += char
+            pos += 1
+        if name:
+            fields[name] = None
+        return fields, pos
+    return parse(0)[0]
+
+
+def project(value, mask):
+    if mask is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, mask) for item in value]
+    return {key: project(value[key], sub) for key, sub in mask.items() if key in value}
+
+
+def time_parse(body, compressed):
+    samples = []
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        json.loads(gzip.decompress(body) if compressed else body)
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    page = make_page()
+    variants = {
+        'full': json.dumps(page).encode(),
+        'fields': json.dumps(project(page, parse_mask(calendar_api.EVENT_LIST_FIELDS))).encode(),
+    }
+    print(f"{PAGE_SIZE} events per page, mask: {calendar_api.EVENT_LIST_FIELDS}")
+    baseline = len(variants['full'])
+    for label, body in variants.items():
+        compressed = gzip.compress(body)
+        for name, payload, is_gzip in ((label, body, False), (f"{label}+gzip", compressed, True)):
+            print(
+                f"{name:<12} {len(payload):>10,} bytes ({len(payload) / baseline:6.1%})  "
+                f"parse p50={time_parse(payload, is_gzip):7.2f} ms"
+            )
+
+
+if __name__ == '__main__':
+    main()
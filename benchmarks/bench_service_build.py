@@ -0,0 +1,74 @@
+"""Cold vs. warm cost of preparing a Calendar request for a command.
+
+Cold: what every command used to do - build('calendar', 'v3') from scratch.
+Warm: the cached path - a service-cache hit followed by request construction.
+
+Run from the repository root: python benchmarks/bench_service_build.py
+No network access is needed; requests are built but never executed.
+"""
+import datetime
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.oauth2.credentials import Credentials  # noqa: E402
+from googleapiclient.discovery import build  # noqa: E402
+
+import calendar_api  # noqa: E402
+
+ITERATIONS = int(os.environ.get('BENCH_ITERATIONS', '200'))
+
+
+def make_credentials():
+    creds = Credentials(token='bench-token', refresh_token='bench-refresh')
+    creds.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    return creds
+
+
+def prepare_list_request(service):
+    now = datetime.datetime.utcnow().isoformat() + 'Z'
+    return service.events().list(
+        calendarId='primary', timeMin=now,
+        maxResults=10, singleEvents=True,
+        orderBy='startTime'
+    )
+
+
+def cold(creds):
+    service = build('calendar', 'v3', credentials=creds, cache_discovery=False)
+    return prepare_list_request(service)
+
+
+def warm(creds):
+    service = calendar_api.get_calendar_service_for(1, creds)
+    return prepare_list_request(service)
+
+
+def measure(label, func, creds):
+    func(creds)  # first call is excluded (imports, discovery load, cache fill)
+    samples = []
+    for _ in range(ITERATIONS):
+        started = time.perf_counter()
+        func(creds)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{label:<6} mean={statistics.mean(samples):8.3f} ms  p50={statistics.median(samples):8.3f} ms  p95={p95:8.3f} ms")
+    return statistics.mean(samples)
+
+
+def main():
+    creds = make_credentials()
+    started = time.perf_counter()
+    calendar_api.load_discovery_document()
+    print(f"startup discovery load: {(time.perf_counter() - started) * 1000:.3f} ms")
+    cold_mean = measure('cold', cold, creds)
+    warm_mean = measure('warm', warm, creds)
+    print(f"speedup: {cold_mean / warm_mean:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
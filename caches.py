@@ -0,0 +1,126 @@
+import datetime
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from google.auth._helpers import REFRESH_THRESHOLD
+
+
+# ==============================================================================
+# 1. GENERIC LRU CACHE WITH PER-ENTRY EXPIRY
+# ==============================================================================
+class LRUCache:
+    """Thread-safe LRU cache bounded by entry count. Each entry carries its own
+    monotonic deadline and is dropped on the first lookup after it passes."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, deadline = entry
+            if deadline is not None and time.monotonic() >= deadline:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        deadline = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, deadline)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def values(self):
+        with self._lock:
+            return [value for value, _ in self._entries.values()]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+# ==============================================================================
+# 2. PER-USER GOOGLE CREDENTIALS CACHE
+# ==============================================================================
+CREDENTIALS_CACHE_SIZE = int(os.environ.get('CREDENTIALS_CACHE_SIZE', '1000'))
+# Evict this many seconds before the access token actually expires. google-auth
+# already treats a token as expired REFRESH_THRESHOLD early and would refresh it
+# inside the HTTP client, so the margin never goes below that.
+CREDENTIALS_EXPIRY_MARGIN = max(
+    int(os.environ.get('CREDENTIALS_EXPIRY_MARGIN', '300')), int(REFRESH_THRESHOLD.total_seconds())
+)
+# Upper bound for tokens that carry no expiry at all.
+CREDENTIALS_MAX_TTL = int(os.environ.get('CREDENTIALS_MAX_TTL', '3300'))
+
+credentials_cache = LRUCache(CREDENTIALS_CACHE_SIZE)
+
+
+def credentials_ttl(creds):
+    if creds.expiry is None:
+        return CREDENTIALS_MAX_TTL
+    # google-auth stores expiry as a naive UTC datetime.
+    remaining = (creds.expiry - datetime.datetime.utcnow()).total_seconds()
+    return min(CREDENTIALS_MAX_TTL, remaining - CREDENTIALS_EXPIRY_MARGIN)
+
+
+def get_cached_credentials(user_id):
+    creds = credentials_cache.get(int(user_id))
+    if creds is not None and not creds.valid:
+        # Refreshing is the caller's job, via the single-flight path.
+        return None
+    return creds
+
+
+def cache_credentials(user_id, creds):
+    ttl = credentials_ttl(creds)
+    if ttl > 0:
+        credentials_cache.put(int(user_id), creds, ttl=ttl)
+
+
+# ==============================================================================
+# 3. PER-USER CALENDAR SERVICE CACHE
+# ==============================================================================
+SERVICE_CACHE_SIZE = int(os.environ.get('SERVICE_CACHE_SIZE', '500'))
+
+service_cache = LRUCache(SERVICE_CACHE_SIZE)
+
+
+def invalidate_user(user_id):
+    credentials_cache.invalidate(int(user_id))
+    service_cache.invalidate(int(user_id))
+
+
+def invalidate_all():
+    credentials_cache.clear()
+    service_cache.clear()
@@ -0,0 +1,354 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import threading
+from urllib.parse import quote
+
+import aiohttp
+import google_auth_httplib2
+import httplib2
+from google.auth.exceptions import RefreshError, TransportError
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.http import HttpRequest
+
+import caches
+import metrics
+from api_gateway import ApiGateway
+from executors import google_executor
+from singleflight import AsyncSingleFlight
+
+# ==============================================================================
+# 1. DISCOVERY DOCUMENT
+# ==============================================================================
+# The Calendar v3 discovery document ships with google-api-python-client. It is
+# read and parsed once per process instead of on every build().
+_discovery_document = None
+_discovery_lock = threading.Lock()
+
+
+def load_discovery_document():
+    global _discovery_document
+    if _discovery_document is None:
+        with _discovery_lock:
+            if _discovery_document is None:
+                doc = get_static_doc('calendar', 'v3')
+                if doc is None:
+                    raise RuntimeError("Calendar v3 discovery document is not bundled with googleapiclient.")
+                _discovery_document = json.loads(doc)
+                logging.info("Loaded Calendar v3 discovery document.")
+    return _discovery_document
+
+# ==============================================================================
+# 2. SERVICE OBJECTS
+# ==============================================================================
+def build_calendar_service(creds):
+    # httplib2 connections are not thread-safe, so a cached Resource hands every
+    # request its own Http object instead of sharing the one it was built with.
+    def build_request(_http, *args, **kwargs):
+        new_http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+        return HttpRequest(new_http, *args, **kwargs)
+
+    authorized_http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+    return build_from_document(load_discovery_document(), http=authorized_http, requestBuilder=build_request)
+
+
+def get_calendar_service_for(user_id, creds):
+    # Reuse the Resource as long as it was built around this exact Credentials
+    # object; a reloaded or re-authorized token gets a fresh one.
+    key = int(user_id)
+    entry = caches.service_cache.get(key)
+    if entry is not None and entry[0] is creds:
+        return entry[1]
+    with metrics.timed('get_calendar_service', 'build'):
+        service = build_calendar_service(creds)
+    caches.service_cache.put(key, (creds, service))
+    return service
+
+# ==============================================================================
+# 3. CALENDAR BACKENDS
+# ==============================================================================
+# Both backends expose the same coroutine interface so the slash commands don't
+# care which one is configured via CALENDAR_BACKEND.
+CALENDAR_BACKEND = os.environ.get('CALENDAR_BACKEND', 'googleapiclient')
+CALENDAR_API_BASE = 'https://www.googleapis.com/calendar/v3'
+CALENDAR_HTTP_TIMEOUT = float(os.environ.get('CALENDAR_HTTP_TIMEOUT', '15'))
+CALENDAR_HTTP_CONNECTIONS = int(os.environ.get('CALENDAR_HTTP_CONNECTIONS', '100'))
+CALENDAR_HTTP_CONNECTIONS_PER_HOST = int(os.environ.get('CALENDAR_HTTP_CONNECTIONS_PER_HOST', '20'))
+CALENDAR_HTTP_KEEPALIVE = float(os.environ.get('CALENDAR_HTTP_KEEPALIVE', '60'))
+# Google only gzips responses for clients whose User-Agent says they accept it.
+# googleapiclient already does this; the aiohttp session sets it explicitly.
+CALENDAR_HTTP_USER_AGENT = 'calendarbot (gzip)'
+
+# Partial-response masks, one per call site, so Google leaves out descriptions,
+# attendee lists, conference data and everything else the bot never reads.
+EVENT_FIELDS = 'id,status,summary,start,end,htmlLink'
+EVENT_LIST_FIELDS = f'items({EVENT_FIELDS}),nextPageToken,nextSyncToken'
+INSERTED_EVENT_FIELDS = 'id,htmlLink'
+CALENDAR_LIST_FIELDS = 'items(id,primary,selected,hidden,deleted),nextPageToken'
+CHANNEL_FIELDS = 'id,resourceId,expiration'
+
+
+class CalendarApiError(Exception):
+    def __init__(self, status, payload):
+        self.status = status
+        self.payload = payload
+        message = payload.get('error', {}).get('message') if isinstance(payload, dict) else payload
+        super().__init__(f"Calendar API returned HTTP {status}: {message}")
+
+
+def error_status(error):
+    # CalendarApiError carries .status; googleapiclient's HttpError carries .resp.status.
+    status = getattr(error, 'status', None)
+    if status is None and getattr(error, 'resp', None) is not None:
+        status = error.resp.status
+    return status
+
+
+def error_reasons(error):
+    payload = getattr(error, 'payload', None)
+    if isinstance(payload, dict):
+        details = payload.get('error', {}).get('errors', [])
+    else:
+        details = getattr(error, 'error_details', None)
+    if not isinstance(details, list):
+        return set()
+    return {detail.get('reason') for detail in details if isinstance(detail, dict)}
+
+
+def classify_calendar_error(error):
+    status = error_status(error)
+    if status == 429 or (status == 403 and error_reasons(error) & {'rateLimitExceeded', 'userRateLimitExceeded'}):
+        return 'rate_limited'
+    if status is not None and status >= 500:
+        return 'server_error'
+    if isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+        return 'network'
+    return None
+
+
+def classify_oauth_error(error):
+    status = error_status(error)
+    if status == 429:
+        return 'rate_limited'
+    if (status is not None and status >= 500) or isinstance(error, TransportError):
+        return 'server_error'
+    if getattr(error, 'retryable', False):
+        # google-auth flags 429/5xx responses from the token endpoint this way.
+        return 'rate_limited'
+    return None
+
+# Global budgets are per process; divide the project quota by the number of
+# bot processes. Per-user budgets match Google's per-user limits.
+calendar_gateway = ApiGateway(
+    'calendar', classify_calendar_error,
+    global_rate=float(os.environ.get('CALENDAR_QUOTA_RATE', '50')),
+    global_burst=int(os.environ.get('CALENDAR_QUOTA_BURST', '100')),
+    user_rate=float(os.environ.get('CALENDAR_USER_QUOTA_RATE', '2')),
+    user_burst=int(os.environ.get('CALENDAR_USER_QUOTA_BURST', '10')),
+    max_wait=float(os.environ.get('CALENDAR_QUOTA_MAX_WAIT', '5')),
+    max_retries=int(os.environ.get('CALENDAR_MAX_RETRIES', '4')),
+    backoff_base=float(os.environ.get('CALENDAR_BACKOFF_BASE', '0.5')),
+    backoff_max=float(os.environ.get('CALENDAR_BACKOFF_MAX', '8')),
+)
+oauth_gateway = ApiGateway(
+    'oauth', classify_oauth_error,
+    global_rate=float(os.environ.get('OAUTH_QUOTA_RATE', '10')),
+    global_burst=int(os.environ.get('OAUTH_QUOTA_BURST', '20')),
+    user_rate=float(os.environ.get('OAUTH_USER_QUOTA_RATE', '0.2')),
+    user_burst=int(os.environ.get('OAUTH_USER_QUOTA_BURST', '3')),
+    max_wait=float(os.environ.get('OAUTH_QUOTA_MAX_WAIT', '5')),
+    max_retries=int(os.environ.get('OAUTH_MAX_RETRIES', '3')),
+    backoff_base=float(os.environ.get('OAUTH_BACKOFF_BASE', '0.5')),
+    backoff_max=float(os.environ.get('OAUTH_BACKOFF_MAX', '8')),
+)
+
+
+class GoogleApiClientBackend:
+    """googleapiclient on worker threads; the original request path."""
+
+    refreshes_credentials = False
+
+    async def _execute(self, user_id, creds, make_request, retry_server_errors=True):
+        def execute():
+            try:
+                result = make_request(get_calendar_service_for(user_id, creds)).execute()
+            except Exception as e:
+                metrics.google_api_calls_total.inc(('googleapiclient', str(error_status(e) or 'error')))
+                raise
+            metrics.google_api_calls_total.inc(('googleapiclient', '200'))
+            return result
+        return await calendar_gateway.call(
+            user_id, lambda: google_executor.run(execute), retry_server_errors=retry_server_errors
+        )
+
+    async def list_events(self, user_id, creds, **params):
+        return await self._execute(user_id, creds, lambda service: service.events().list(**params))
+
+    async def list_calendars(self, user_id, creds, **params):
+        return await self._execute(user_id, creds, lambda service: service.calendarList().list(**params))
+
+    async def insert_event(self, user_id, creds, calendar_id, body, fields=None):
+        params = {'fields': fields} if fields else {}
+        return await self._execute(
+            user_id, creds, lambda service: service.events().insert(calendarId=calendar_id, body=body, **params),
+            retry_server_errors=False,
+        )
+
+    async def watch_events(self, user_id, creds, calendar_id, body, fields=None):
+        params = {'fields': fields} if fields else {}
+        return await self._execute(
+            user_id, creds, lambda service: service.events().watch(calendarId=calendar_id, body=body, **params),
+            retry_server_errors=False,
+        )
+
+    async def stop_channel(self, user_id, creds, body):
+        return await self._execute(user_id, creds, lambda service: service.channels().stop(body=body))
+
+    async def warm_up(self, user_id, creds):
+        await google_executor.run(get_calendar_service_for, user_id, creds)
+
+    async def close(self):
+        pass
+
+
+class AioHttpCalendarClient:
+    """Native asyncio Calendar v3 client over one keep-alive aiohttp session.
+    It refreshes expired access tokens itself, so callers can hand it expired
+    credentials; concurrent refreshes for one user share a single request."""
+
+    refreshes_credentials = True
+
+    def __init__(self, on_refresh=None, on_revoked=None):
+        # on_refresh(user_id, creds) persists credentials refreshed by this
+        # client; on_revoked(user_id) runs when Google rejects the refresh token.
+        self.on_refresh = on_refresh
+        self.on_revoked = on_revoked
+        self._session = None
+        self.refresh_flight = AsyncSingleFlight()
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=CALENDAR_HTTP_CONNECTIONS,
+                limit_per_host=CALENDAR_HTTP_CONNECTIONS_PER_HOST,
+                keepalive_timeout=CALENDAR_HTTP_KEEPALIVE,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=CALENDAR_HTTP_TIMEOUT),
+                headers={'User-Agent': CALENDAR_HTTP_USER_AGENT, 'Accept-Encoding': 'gzip'},
+            )
+        return self._session
+
+    @staticmethod
+    def _query(params):
+        return {key: str(value).lower() if isinstance(value, bool) else str(value) for key, value in params.items()}
+
+    async def refresh_credentials(self, user_id, creds):
+        token, expiry = await self.refresh_flight.do(int(user_id), lambda: self._refresh(user_id, creds))
+        creds.token = token
+        creds.expiry = expiry
+
+    async def _refresh(self, user_id, creds):
+        data = {
+            'grant_type': 'refresh_token',
+            'refresh_token': creds.refresh_token,
+            'client_id': creds.client_id,
+            'client_secret': creds.client_secret,
+        }
+
+        async def post():
+            async with self._get_session().post(creds.token_uri, data=data) as resp:
+                payload = await resp.json(content_type=None)
+            if resp.status == 429 or resp.status >= 500:
+                raise CalendarApiError(resp.status, payload)
+            if resp.status != 200:
+                raise RefreshError(f"Token refresh failed with HTTP {resp.status}: {payload}")
+            return payload
+
+        try:
+            payload = await oauth_gateway.call(user_id, post)
+        except RefreshError:
+            if self.on_revoked:
+                await self.on_revoked(user_id)
+            raise
+        creds.token = payload['access_token']
+        creds.expiry = datetime.datetime.utcnow() + datetime.timedelta(seconds=payload.get('expires_in', 3600))
+        if self.on_refresh:
+            await self.on_refresh(user_id, creds)
+        return creds.token, creds.expiry
+
+    async def _send(self, token, method, path, params, body):
+        headers = {'Authorization': f'Bearer {token}'}
+        async with self._get_session().request(
+            method, f"{CALENDAR_API_BASE}{path}",
+            params=self._query(params or {}), json=body, headers=headers
+        ) as resp:
+            payload = await resp.json(content_type=None)
+        metrics.google_api_calls_total.inc(('aiohttp', str(resp.status)))
+        if resp.status >= 400:
+            raise CalendarApiError(resp.status, payload)
+        return payload
+
+    async def _request(self, user_id, creds, method, path, params=None, body=None, retry_server_errors=True):
+        for attempt in range(2):
+            if not creds.valid:
+                await self.refresh_credentials(user_id, creds)
+            token = creds.token
+            try:
+                return await calendar_gateway.call(
+                    user_id, lambda: self._send(token, method, path, params, body),
+                    retry_server_errors=retry_server_errors,
+                )
+            except CalendarApiError as e:
+                if e.status == 401 and attempt == 0 and creds.refresh_token:
+                    # Token was revoked or expired server-side; refresh once and retry.
+                    # A concurrent command may already have replaced it.
+                    if creds.token == token:
+                        creds.token = None
+                    continue
+                raise
+
+    async def list_events(self, user_id, creds, calendarId='primary', **params):
+        path = f"/calendars/{quote(calendarId, safe='')}/events"
+        return await self._request(user_id, creds, 'GET', path, params=params)
+
+    async def list_calendars(self, user_id, creds, **params):
+        return await self._request(user_id, creds, 'GET', '/users/me/calendarList', params=params)
+
+    async def insert_event(self, user_id, creds, calendar_id, body, fields=None):
+        path = f"/calendars/{quote(calendar_id, safe='')}/events"
+        params = {'fields': fields} if fields else None
+        return await self._request(
+            user_id, creds, 'POST', path, params=params, body=body, retry_server_errors=False
+        )
+
+    async def watch_events(self, user_id, creds, calendar_id, body, fields=None):
+        path = f"/calendars/{quote(calendar_id, safe='')}/events/watch"
+        params = {'fields': fields} if fields else None
+        return await self._request(
+            user_id, creds, 'POST', path, params=params, body=body, retry_server_errors=False
+        )
+
+    async def stop_channel(self, user_id, creds, body):
+        return await self._request(user_id, creds, 'POST', '/channels/stop', body=body)
+
+    async def warm_up(self, user_id, creds):
+        # Nothing is built per user; just make sure the shared session exists.
+        self._get_session()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+def create_calendar_backend(on_refresh=None, on_revoked=None):
+    if CALENDAR_BACKEND == 'aiohttp':
+        logging.info("Using the aiohttp Calendar backend.")
+        return AioHttpCalendarClient(on_refresh=on_refresh, on_revoked=on_revoked)
+    if CALENDAR_BACKEND != 'googleapiclient':
+        raise ValueError(f"Unknown CALENDAR_BACKEND: {CALENDAR_BACKEND}")
+    return GoogleApiClientBackend()
@@ -0,0 +1,111 @@
+import datetime
+import functools
+import logging
+import os
+import re
+import time
+
+from dateparser.date import DateDataParser
+
+# ==============================================================================
+# 1. CONFIGURATION
+# ==============================================================================
+DATEPARSER_LANGUAGES = [lang.strip() for lang in os.environ.get('DATEPARSER_LANGUAGES', 'en').split(',') if lang.strip()]
+# Relative phrases ("in 2 hours") resolve against the start of this bucket, so
+# repeated phrases within it are answered from the memo.
+DATEPARSE_BUCKET_SECONDS = int(os.environ.get('DATEPARSE_BUCKET_SECONDS', '60'))
+DATEPARSE_CACHE_SIZE = int(os.environ.get('DATEPARSE_CACHE_SIZE', '4096'))
+
+# Built once: restricting languages skips dateparser's per-call language detection.
+_parser = DateDataParser(languages=DATEPARSER_LANGUAGES)
+
+# ==============================================================================
+# 2. HAND-WRITTEN FAST PATHS
+# ==============================================================================
+_WHITESPACE = re.compile(r'\s+')
+_DAY_AND_TIME = re.compile(
+    r'^(?:(?P<day>today|tomorrow)(?:\s+at)?\s*)?'
+    r'(?:(?P<hour>\d{1,2})(?::(?P<minute>\d{2}))?\s*(?P<meridiem>am|pm)?)?$'
+)
+
+
+def _normalize(text):
+    return _WHITESPACE.sub(' ', text.strip().lower())
+
+
+def _parse_iso(text):
+    try:
+        return datetime.datetime.fromisoformat(text.upper().replace('Z', '+00:00'))
+    except ValueError:
+        return None
+
+
+def _parse_day_and_time(text, reference):
+    match = _DAY_AND_TIME.match(text)
+    if not match or not text:
+        return None
+    day, hour, minute, meridiem = match.group('day', 'hour', 'minute', 'meridiem')
+    base = reference + datetime.timedelta(days=1) if day == 'tomorrow' else reference
+    if hour is None:
+        return base  # Bare "today"/"tomorrow" keep the current time, like dateparser.
+    if minute is None and meridiem is None:
+        return None  # A lone number ("3") is a day of month to dateparser.
+
+    hour, minute = int(hour), int(minute or 0)
+    if meridiem:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if meridiem == 'pm' else 0)
+    if hour > 23 or minute > 59:
+        return None
+    return base.replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+
+def parse_fast(text, reference):
+    # Must start with a digit to be ISO; otherwise fromisoformat is wasted work.
+    if text[:1].isdigit() and ('-' in text):
+        parsed = _parse_iso(text)
+        if parsed:
+            return parsed
+    return _parse_day_and_time(text, reference)
+
+# ==============================================================================
+# 3. MEMOIZED PARSING
+# ==============================================================================
+@functools.lru_cache(maxsize=DATEPARSE_CACHE_SIZE)
+def _parse_in_bucket(text, bucket):
+    reference = datetime.datetime.fromtimestamp(bucket * DATEPARSE_BUCKET_SECONDS)
+    parsed = parse_fast(text, reference)
+    if parsed is not None:
+        return parsed
+    return _parser.get_date_data(text).date_obj
+
+
+def parse_when(text, now=None):
+    """Parse a natural-language date/time the way dateparser.parse would.
+
+    Returns a naive local datetime (or an aware one when the input carries an
+    offset), or None when the phrase can't be understood."""
+    now = now or datetime.datetime.now()
+    bucket = int(now.timestamp()) // DATEPARSE_BUCKET_SECONDS
+    return _parse_in_bucket(_normalize(text), bucket)
+
+
+def cache_stats():
+    info = _parse_in_bucket.cache_info()
+    return {'hits': info.hits, 'misses': info.misses, 'entries': info.currsize, 'max_entries': info.maxsize}
+
+
+_warmed = False
+
+
+def warm_up():
+    # dateparser loads its language data lazily on the first parse.
+    global _warmed
+    if _warmed:
+        return
+    started = time.perf_counter()
+    for phrase in ('next friday at noon', 'in 2 hours', '25 december 2030 18:00'):
+        _parser.get_date_data(phrase)
+    _warmed = True
+    logging.info(f"Date parser warmed up in {(time.perf_counter() - started) * 1000:.0f} ms.")
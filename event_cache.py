@@ -0,0 +1,382 @@
+import asyncio
+import datetime
+import heapq
+import json
+import logging
+import os
+import time
+
+import token_store
+from caches import LRUCache
+from calendar_api import CALENDAR_LIST_FIELDS, EVENT_LIST_FIELDS, error_status
+from executors import db_executor
+
+# ==============================================================================
+# 1. CONFIGURATION
+# ==============================================================================
+EVENT_CACHE_SIZE = int(os.environ.get('EVENT_CACHE_SIZE', '1000'))
+# How long a synced calendar is served from memory before asking Google for changes.
+EVENT_CACHE_TTL = float(os.environ.get('EVENT_CACHE_TTL', '60'))
+# Users with an active push channel are told about changes, so their cache can
+# live much longer; the TTL only guards against missed notifications.
+EVENT_CACHE_PUSH_TTL = float(os.environ.get('EVENT_CACHE_PUSH_TTL', '3600'))
+EVENT_CACHE_PERSIST = os.environ.get('EVENT_CACHE_PERSIST', '0') == '1'
+# The initial full sync starts this far in the past so events in progress are kept.
+EVENT_SYNC_LOOKBACK_HOURS = int(os.environ.get('EVENT_SYNC_LOOKBACK_HOURS', '24'))
+EVENT_SYNC_PAGE_SIZE = int(os.environ.get('EVENT_SYNC_PAGE_SIZE', '250'))
+EVENT_SYNC_MAX_PAGES = int(os.environ.get('EVENT_SYNC_MAX_PAGES', '20'))
+# Calendars with more than EVENT_SYNC_MAX_PAGES pages are streamed from Google
+# instead of synced; this is how long before a sync is attempted again.
+EVENT_UNCACHEABLE_TTL = float(os.environ.get('EVENT_UNCACHEABLE_TTL', '86400'))
+# Which calendars /events reads:
+#   primary  - only the user's primary calendar
+#   selected - every calendar the user has ticked in Google Calendar
+#   all      - every calendar in the user's calendar list
+EVENT_CALENDARS = os.environ.get('EVENT_CALENDARS', 'primary')
+EVENT_MAX_CALENDARS = int(os.environ.get('EVENT_MAX_CALENDARS', '10'))
+CALENDAR_LIST_TTL = float(os.environ.get('CALENDAR_LIST_TTL', '600'))
+# Ranged listings stop after this many events; calendars too large to cache
+# are paged from Google this many events at a time.
+EVENT_RANGE_MAX_EVENTS = int(os.environ.get('EVENT_RANGE_MAX_EVENTS', '500'))
+EVENT_STREAM_PAGE_SIZE = int(os.environ.get('EVENT_STREAM_PAGE_SIZE', '50'))
+
+# ==============================================================================
+# 2. PER-USER SYNC STATE
+# ==============================================================================
+def _start_key(event):
+    return _parse_event_time(event['start'])
+
+
+async def _iterate(events):
+    for event in events:
+        yield event
+
+
+def _parse_event_time(value):
+    if 'dateTime' in value:
+        return datetime.datetime.fromisoformat(value['dateTime'].replace('Z', '+00:00'))
+    # All-day events only carry a date; treat them as starting at midnight UTC.
+    return datetime.datetime.fromisoformat(value['date']).replace(tzinfo=datetime.timezone.utc)
+
+
+class UserEvents:
+    def __init__(self):
+        self.sync_token = None
+        self.events = {}
+        self.synced_at = 0.0
+        self.stale = True
+        self.push_active = False
+        self.uncacheable_at = None
+        self.version = 0
+        self.lock = asyncio.Lock()
+        self._sorted = None
+
+    def clear(self):
+        self.events.clear()
+        self.version += 1
+        self._sorted = None
+
+    def is_fresh(self):
+        ttl = EVENT_CACHE_PUSH_TTL if self.push_active else EVENT_CACHE_TTL
+        return not self.stale and time.monotonic() - self.synced_at < ttl
+
+    def is_uncacheable(self):
+        return self.uncacheable_at is not None and time.monotonic() - self.uncacheable_at < EVENT_UNCACHEABLE_TTL
+
+    def apply(self, items):
+        changed = False
+        for event in items:
+            if event.get('status') == 'cancelled':
+                changed |= self.events.pop(event['id'], None) is not None
+            elif 'start' in event:
+                self.events[event['id']] = event
+                changed = True
+        if changed:
+            self.version += 1
+            self._sorted = None
+        return changed
+
+    def prune(self, before):
+        expired = [event_id for event_id, event in self.events.items() if _parse_event_time(event.get('end', event['start'])) < before]
+        for event_id in expired:
+            del self.events[event_id]
+        if expired:
+            self.version += 1
+            self._sorted = None
+
+    def between(self, start, end=None):
+        # Lazily walks a snapshot of the sorted events, so a sync that lands
+        # mid-iteration doesn't disturb a listing in progress.
+        if self._sorted is None:
+            self._sorted = sorted(self.events.values(), key=_start_key)
+        for event in self._sorted:
+            if end is not None and _start_key(event) >= end:
+                return
+            if _parse_event_time(event.get('end', event['start'])) > start:
+                yield event
+
+# ==============================================================================
+# 3. INCREMENTALLY SYNCED EVENT CACHE
+# ==============================================================================
+class EventCache:
+    """Keeps each user's calendars in memory and refreshes them with Calendar's
+    incremental sync (syncToken) instead of re-listing every time. Every
+    calendar is synced on its own; only the primary one is persisted and
+    watched for push notifications."""
+
+    def __init__(self, backend, max_entries=EVENT_CACHE_SIZE, persist=EVENT_CACHE_PERSIST, calendars=EVENT_CALENDARS):
+        self.backend = backend
+        self.persist = persist
+        self.calendars = calendars
+        self._users = LRUCache(max_entries)
+        self._calendar_lists = LRUCache(max_entries)
+        self.full_syncs = 0
+        self.incremental_syncs = 0
+
+    async def _state_for(self, user_id, calendar_id='primary'):
+        key = (int(user_id), calendar_id)
+        state = self._users.get(key)
+        if state is None:
+            state = UserEvents()
+            if self.persist and calendar_id == 'primary':
+                await self._load_persisted(int(user_id), state)
+            self._users.put(key, state)
+        return state
+
+    async def calendar_ids(self, user_id, creds):
+        if self.calendars == 'primary':
+            return ['primary']
+        key = int(user_id)
+        # Kept without a TTL so drop() can still find every calendar's state
+        # after the list itself is due for a refresh.
+        previous = self._calendar_lists.get(key)
+        if previous is not None and time.monotonic() - previous[1] < CALENDAR_LIST_TTL:
+            return previous[0]
+        calendar_ids = ['primary']
+        page_token = None
+        while True:
+            params = {'minAccessRole': 'reader', 'maxResults': 250, 'fields': CALENDAR_LIST_FIELDS}
+            if page_token:
+                params['pageToken'] = page_token
+            result = await self.backend.list_calendars(user_id, creds, **params)
+            for entry in result.get('items', []):
+                if entry.get('primary') or entry.get('deleted') or entry.get('hidden'):
+                    continue
+                if self.calendars == 'selected' and not entry.get('selected'):
+                    continue
+                calendar_ids.append(entry['id'])
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                break
+        calendar_ids = calendar_ids[:EVENT_MAX_CALENDARS]
+        if previous is not None:
+            for calendar_id in set(previous[0]) - set(calendar_ids):
+                self._users.invalidate((key, calendar_id))
+        self._calendar_lists.put(key, (calendar_ids, time.monotonic()))
+        return calendar_ids
+
+    async def _load_persisted(self, user_id, state):
+        try:
+            row = await db_executor.run(token_store.load_event_sync_state, user_id)
+        except Exception as e:
+            logging.error(f"Could not load persisted events for user {user_id}: {e}")
+            return
+        if row:
+            state.sync_token, events = row
+            state.apply(events)
+
+    async def iter_range(self, user_id, creds, time_min, time_max=None, page_size=10, limit=EVENT_RANGE_MAX_EVENTS):
+        """Async generator of pages (lists of up to page_size events) starting
+        at time_min. Nothing past the page being consumed is fetched, so a
+        caller that stops early never pays for the rest of the range."""
+        streams = []
+        for calendar_id, state in await self._fresh_states(user_id, creds):
+            if state.is_uncacheable():
+                # Too big to cache completely; page through Google instead.
+                streams.append(self._stream_remote(user_id, creds, calendar_id, time_min, time_max))
+            else:
+                streams.append(_iterate(state.between(time_min, time_max)))
+
+        page, count = [], 0
+        async for event in self._merge_streams(streams):
+            page.append(event)
+            count += 1
+            if len(page) == page_size or count == limit:
+                yield page
+                page = []
+            if count == limit:
+                return
+        if page:
+            yield page
+
+    @staticmethod
+    async def _merge_streams(streams):
+        # heapq.merge for async iterators: one head per calendar on the heap,
+        # so nothing is pulled from a calendar before its events are due.
+        heads = await asyncio.gather(*(anext(stream, None) for stream in streams))
+        heap = [(_start_key(event), index, event) for index, event in enumerate(heads) if event is not None]
+        heapq.heapify(heap)
+        seen = set()
+        while heap:
+            _, index, event = heapq.heappop(heap)
+            # An invitation shows up in every invited calendar with the same ID.
+            if event['id'] not in seen:
+                seen.add(event['id'])
+                yield event
+            following = await anext(streams[index], None)
+            if following is not None:
+                heapq.heappush(heap, (_start_key(following), index, following))
+
+    async def _stream_remote(self, user_id, creds, calendar_id, time_min, time_max):
+        page_token = None
+        while True:
+            params = {
+                'calendarId': calendar_id, 'timeMin': time_min.isoformat(), 'singleEvents': True,
+                'orderBy': 'startTime', 'maxResults': EVENT_STREAM_PAGE_SIZE, 'fields': EVENT_LIST_FIELDS,
+            }
+            if time_max:
+                params['timeMax'] = time_max.isoformat()
+            if page_token:
+                params['pageToken'] = page_token
+            result = await self.backend.list_events(user_id, creds, **params)
+            for event in result.get('items', []):
+                if event.get('status') != 'cancelled':
+                    yield event
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                return
+
+    async def _fresh_states(self, user_id, creds):
+        # (calendar_id, synced state) for every calendar that could be synced;
+        # a failing secondary calendar is skipped rather than failing the command.
+        calendar_ids = await self.calendar_ids(user_id, creds)
+        results = await asyncio.gather(
+            *(self._fresh_state(user_id, creds, calendar_id) for calendar_id in calendar_ids),
+            return_exceptions=True
+        )
+        states = []
+        for calendar_id, result in zip(calendar_ids, results):
+            if isinstance(result, BaseException):
+                if calendar_id == 'primary':
+                    raise result
+                logging.warning(f"Skipping calendar {calendar_id} for user {user_id}: {result}")
+                continue
+            states.append((calendar_id, result))
+        return states
+
+    async def _fresh_state(self, user_id, creds, calendar_id):
+        state = await self._state_for(user_id, calendar_id)
+        if state.is_uncacheable():
+            return state
+        if not state.is_fresh():
+            async with state.lock:
+                # Another command may have synced while this one waited for the lock.
+                if not state.is_fresh():
+                    await self._sync(user_id, creds, state, calendar_id)
+        return state
+
+    async def _sync(self, user_id, creds, state, calendar_id='primary'):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        changed = False
+        if state.sync_token:
+            try:
+                changed = await self._fetch(user_id, creds, state, calendar_id, {'syncToken': state.sync_token})
+                self.incremental_syncs += 1
+            except Exception as e:
+                if error_status(e) != 410:
+                    raise
+                # Sync token expired on Google's side; start over with a full sync.
+                logging.info(f"Sync token for user {user_id} expired, running a full sync.")
+                state.sync_token = None
+        if not state.sync_token and not state.is_uncacheable():
+            state.clear()
+            lookback = now - datetime.timedelta(hours=EVENT_SYNC_LOOKBACK_HOURS)
+            await self._fetch(user_id, creds, state, calendar_id, {'timeMin': lookback.isoformat()})
+            self.full_syncs += 1
+            changed = True
+        if state.is_uncacheable():
+            return
+
+        state.prune(now - datetime.timedelta(hours=EVENT_SYNC_LOOKBACK_HOURS))
+        state.synced_at = time.monotonic()
+        state.stale = False
+        if changed and self.persist and calendar_id == 'primary':
+            await self._save_persisted(user_id, state)
+
+    async def _fetch(self, user_id, creds, state, calendar_id, params):
+        changed = False
+        page_token = None
+        for _ in range(EVENT_SYNC_MAX_PAGES):
+            page_params = dict(
+                params, calendarId=calendar_id, singleEvents=True, maxResults=EVENT_SYNC_PAGE_SIZE,
+                fields=EVENT_LIST_FIELDS
+            )
+            if page_token:
+                page_params['pageToken'] = page_token
+            result = await self.backend.list_events(user_id, creds, **page_params)
+            changed |= state.apply(result.get('items', []))
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                state.sync_token = result.get('nextSyncToken')
+                return changed
+        # Too many pages to hold a complete copy; stream this calendar from
+        # Google until EVENT_UNCACHEABLE_TTL has passed.
+        logging.warning(f"Calendar {calendar_id} for user {user_id} exceeded {EVENT_SYNC_MAX_PAGES} pages; streaming it instead.")
+        state.sync_token = None
+        state.uncacheable_at = time.monotonic()
+        state.clear()
+        return True
+
+    async def _save_persisted(self, user_id, state):
+        try:
+            await db_executor.run(
+                token_store.save_event_sync_state, user_id, state.sync_token, json.dumps(list(state.events.values()))
+            )
+        except Exception as e:
+            logging.error(f"Could not persist events for user {user_id}: {e}")
+
+    def _known_calendars(self, key):
+        entry = self._calendar_lists.get(key)
+        return entry[0] if entry else ['primary']
+
+    def _states(self, user_id):
+        key = int(user_id)
+        for calendar_id in self._known_calendars(key):
+            state = self._users.get((key, calendar_id))
+            if state is not None:
+                yield state
+
+    def version(self, user_id):
+        # Changes whenever any of the user's cached calendars gains, loses or
+        # changes an event; used to key rendered pages.
+        return tuple(state.version for state in self._states(user_id))
+
+    def invalidate(self, user_id):
+        # Keeps the sync tokens so the next read is an incremental sync.
+        for state in self._states(user_id):
+            state.stale = True
+
+    def set_push_active(self, user_id, active):
+        # Push channels only watch the primary calendar.
+        state = self._users.get((int(user_id), 'primary'))
+        if state is not None:
+            state.push_active = active
+
+    def invalidate_all(self):
+        for state in self._users.values():
+            state.stale = True
+
+    def drop(self, user_id):
+        key = int(user_id)
+        for calendar_id in self._known_calendars(key):
+            self._users.invalidate((key, calendar_id))
+        self._calendar_lists.invalidate(key)
+
+    def forget(self, user_id):
+        # Drops everything, e.g. when the user connects a different Google account.
+        self.drop(user_id)
+        if self.persist:
+            token_store.delete_event_sync_state(user_id)
+
+    def stats(self):
+        return dict(self._users.stats(), full_syncs=self.full_syncs, incremental_syncs=self.incremental_syncs)
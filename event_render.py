@@ -0,0 +1,69 @@
+import datetime
+import os
+from functools import lru_cache
+
+import discord
+
+from caches import LRUCache
+
+# ==============================================================================
+# 1. EVENT FORMATTING
+# ==============================================================================
+# Every page stays within this many characters, which fits a plain message as
+# well as an embed description.
+RENDER_PAGE_CHARS = int(os.environ.get('RENDER_PAGE_CHARS', '2000'))
+RENDER_CACHE_SIZE = int(os.environ.get('RENDER_CACHE_SIZE', '2000'))
+RENDER_CACHE_TTL = float(os.environ.get('RENDER_CACHE_TTL', '600'))
+EMBED_COLOUR = 0x4285F4
+
+
+@lru_cache(maxsize=4096)
+def format_start(value):
+    # value is an event's start.dateTime or start.date string; the same events
+    # are shown over and over, so each one is only parsed and formatted once.
+    if 'T' in value:
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).strftime('%A, %B %d at %I:%M %p')
+    return datetime.datetime.fromisoformat(value).strftime('%A, %B %d (All Day)')
+
+
+def _truncate(text, limit):
+    return text if len(text) <= limit else text[:max(0, limit - 1)] + '…'
+
+
+def render_page(title, events, page_index, page_size):
+    lines = []
+    for event in events:
+        start = event['start'].get('dateTime', event['start'].get('date'))
+        lines.append((event.get('summary') or '(No title)', format_start(start)))
+
+    # Long titles are shortened just enough for the whole page to fit.
+    fixed = sum(len(f"**- ** on {when}\n") for _, when in lines)
+    summary_budget = max(1, (RENDER_PAGE_CHARS - fixed) // max(1, len(lines)))
+    description = ''.join(
+        f"**- {discord.utils.escape_markdown(_truncate(summary, summary_budget))}** on {when}\n"
+        for summary, when in lines
+    )
+    # Escaping can add characters back; the hard cap is a last resort.
+    embed = discord.Embed(title=f"📅 {title}", description=_truncate(description, RENDER_PAGE_CHARS), colour=EMBED_COLOUR)
+    first = page_index * page_size + 1
+    embed.set_footer(text=f"Page {page_index + 1} · events {first}–{first + len(events) - 1}")
+    return embed
+
+# ==============================================================================
+# 2. RENDERED PAGE CACHE
+# ==============================================================================
+# Keys end in (event-set version, page index), so a page is rendered once per
+# version of the user's events and every later view of it is a dict lookup.
+render_cache = LRUCache(RENDER_CACHE_SIZE)
+
+
+def cached_page(key):
+    return render_cache.get(key)
+
+
+def render_cached(key, title, events, page_index, page_size):
+    embed = render_cache.get(key)
+    if embed is None:
+        embed = render_page(title, events, page_index, page_size)
+        render_cache.put(key, embed, ttl=RENDER_CACHE_TTL)
+    return embed
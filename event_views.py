@@ -0,0 +1,155 @@
+import asyncio
+import datetime
+import logging
+import os
+
+import discord
+
+import event_render
+
+# ==============================================================================
+# 1. LISTING RANGES
+# ==============================================================================
+EVENTS_PAGE_SIZE = int(os.environ.get('EVENTS_PAGE_SIZE', '10'))
+EVENTS_MAX_DAYS = int(os.environ.get('EVENTS_MAX_DAYS', '90'))
+# Discord interaction tokens last 15 minutes, so the buttons must give up first.
+EVENTS_VIEW_TIMEOUT = float(os.environ.get('EVENTS_VIEW_TIMEOUT', '600'))
+
+PERIODS = {
+    'upcoming': 'Your upcoming events',
+    'today': "Today's events",
+    'week': "This week's events",
+    'days': 'Your events in the next {days} days',
+}
+EMPTY_MESSAGES = {
+    'upcoming': 'You have no upcoming events.',
+    'today': 'You have no more events today.',
+    'week': 'You have no more events this week.',
+    'days': 'You have no events in the next {days} days.',
+}
+
+
+def empty_message(period, days):
+    return EMPTY_MESSAGES[period].format(days=days)
+
+
+def period_window(period, days, now):
+    # Returns (time_min, time_max, title); dates are UTC like /addevent's.
+    title = PERIODS[period].format(days=days)
+    if period == 'today':
+        return now, datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(), now.tzinfo), title
+    if period == 'week':
+        # Up to the end of Sunday.
+        end = now.date() + datetime.timedelta(days=7 - now.weekday())
+        return now, datetime.datetime.combine(end, datetime.time(), now.tzinfo), title
+    if period == 'days':
+        return now, now + datetime.timedelta(days=days), title
+    return now, None, title
+
+# ==============================================================================
+# 2. LAZY PAGINATION
+# ==============================================================================
+class EventPager:
+    """Pulls pages from an EventCache.iter_range generator only when they are
+    first shown; pages already seen are kept for the Previous button. A page
+    shorter than page_size is the last one, so Next is disabled on it without
+    fetching ahead."""
+
+    def __init__(self, pages, page_size=EVENTS_PAGE_SIZE):
+        self._pages = pages
+        self.page_size = page_size
+        self.loaded = []
+        self.exhausted = False
+
+    async def get(self, index):
+        while len(self.loaded) <= index and not self.exhausted:
+            try:
+                page = await anext(self._pages)
+            except StopAsyncIteration:
+                self.exhausted = True
+                break
+            self.loaded.append(page)
+            if len(page) < self.page_size:
+                self.exhausted = True
+        return self.loaded[index] if index < len(self.loaded) else None
+
+    def has_next(self, index):
+        return index + 1 < len(self.loaded) or not self.exhausted
+
+    async def close(self):
+        await self._pages.aclose()
+
+
+class EventsView(discord.ui.View):
+    """Previous/Next buttons over an EventPager. Rendered pages live in
+    event_render's cache under cache_key + (page,); cache_key ends in the
+    event-set version the pager was created at, so revisiting a page of an
+    unchanged event set costs neither rendering nor a Google call."""
+
+    def __init__(self, owner_id, pager, title, cache_key):
+        super().__init__(timeout=EVENTS_VIEW_TIMEOUT)
+        self.owner_id = owner_id
+        self.pager = pager
+        self.title = title
+        self.cache_key = cache_key
+        self.index = 0
+        self.message = None
+        self._current = None
+        self._lock = asyncio.Lock()
+        self._update_buttons()
+
+    def _page_key(self, index):
+        return self.cache_key + (index,)
+
+    def embed(self):
+        self._current = event_render.render_cached(
+            self._page_key(self.index), self.title, self.pager.loaded[self.index], self.index, EVENTS_PAGE_SIZE
+        )
+        return self._current
+
+    def _update_buttons(self):
+        self.previous_page.disabled = self.index == 0
+        self.next_page.disabled = not self.pager.has_next(self.index)
+
+    async def interaction_check(self, interaction):
+        return interaction.user.id == self.owner_id
+
+    @discord.ui.button(label='◀ Previous', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self._show(interaction, self.index - 1)
+
+    @discord.ui.button(label='Next ▶', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self._show(interaction, self.index + 1)
+
+    async def _show(self, interaction, index):
+        await interaction.response.defer()
+        # Clicks are serialized so two of them never pull the same page twice.
+        async with self._lock:
+            embed = event_render.cached_page(self._page_key(index))
+            if embed is None:
+                try:
+                    events = await self.pager.get(index)
+                except Exception as e:
+                    logging.error(f"Could not load page {index + 1} of events for user {self.owner_id}: {e}")
+                    await interaction.followup.send("Sorry, I couldn't load more events right now.", ephemeral=True)
+                    return
+                if events:
+                    embed = event_render.render_cached(
+                        self._page_key(index), self.title, events, index, EVENTS_PAGE_SIZE
+                    )
+            if embed is not None:
+                self.index = index
+                self._current = embed
+            self._update_buttons()
+            await interaction.edit_original_response(embed=self._current, view=self)
+
+    async def on_timeout(self):
+        await self.pager.close()
+        for item in self.children:
+            item.disabled = True
+        if self.message is not None:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# ==============================================================================
+# 1. BOUNDED EXECUTORS
+# ==============================================================================
+class ExecutorBusy(Exception):
+    def __init__(self, name):
+        self.name = name
+        super().__init__(f"The {name} executor is saturated")
+
+
+class BoundedExecutor:
+    """Named thread pool that rejects work once `max_queue` jobs are already
+    waiting for a worker, instead of letting the backlog grow forever."""
+
+    def __init__(self, name, max_workers, max_queue):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    async def run(self, func, *args):
+        with self._lock:
+            if self.pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise ExecutorBusy(self.name)
+            self.pending += 1
+
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._done(None)
+            raise
+        # Counted down when the job finishes or is cancelled while still
+        # queued (a cancelled awaiter cancels it), never on the awaiter's side.
+        future.add_done_callback(self._done)
+        return await asyncio.wrap_future(future)
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+            if future is not None and not future.cancelled():
+                self.completed += 1
+
+    def queue_depth(self):
+        return max(0, self.pending - self.max_workers)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'pending': self.pending,
+                'queue_depth': max(0, self.pending - self.max_workers),
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+# ==============================================================================
+# 2. SHARED EXECUTORS
+# ==============================================================================
+# Slow Google round-trips, quick DB lookups and CPU-bound parsing each get their
+# own pool so a burst of one can't starve the others.
+google_executor = BoundedExecutor(
+    'google',
+    int(os.environ.get('GOOGLE_EXECUTOR_WORKERS', '16')),
+    int(os.environ.get('GOOGLE_EXECUTOR_QUEUE', '64')),
+)
+db_executor = BoundedExecutor(
+    'db',
+    int(os.environ.get('DB_EXECUTOR_WORKERS', '8')),
+    int(os.environ.get('DB_EXECUTOR_QUEUE', '64')),
+)
+parse_executor = BoundedExecutor(
+    'parse',
+    int(os.environ.get('PARSE_EXECUTOR_WORKERS', '2')),
+    int(os.environ.get('PARSE_EXECUTOR_QUEUE', '32')),
+)
+
+ALL_EXECUTORS = (google_executor, db_executor, parse_executor)
+
+
+def executor_stats():
+    return {executor.name: executor.stats() for executor in ALL_EXECUTORS}
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import os
+import uuid
+
+import psycopg2
+import psycopg2.extensions
+
+from executors import db_executor
+
+# ==============================================================================
+# 1. CROSS-PROCESS CACHE INVALIDATION (POSTGRES LISTEN/NOTIFY)
+# ==============================================================================
+# google_tokens_changed is raised by a trigger on google_tokens (migration 6)
+# for every insert, update and delete, whoever makes it. calendar_changed is
+# raised by the process that receives a Calendar push notification.
+TOKEN_CHANNEL = 'google_tokens_changed'
+CALENDAR_CHANNEL = 'calendar_changed'
+# Every pooled connection uses this as its application_name; the trigger puts
+# it in the payload so a process can skip the notifications it caused itself.
+PROCESS_ID = uuid.uuid4().hex[:12]
+APPLICATION_NAME = f"calendarbot-{PROCESS_ID}"
+LISTENER_RECONNECT_DELAY = float(os.environ.get('LISTENER_RECONNECT_DELAY', '5'))
+
+
+def calendar_change_payload(user_id):
+    return f"{user_id}:{APPLICATION_NAME}:events"
+
+
+def parse_payload(payload):
+    # "<user_id>:<origin application_name>:<kind>"
+    user_id, rest = payload.split(':', 1)
+    origin, _, kind = rest.rpartition(':')
+    return int(user_id), origin, kind
+
+
+class InvalidationListener:
+    """Holds one dedicated LISTEN connection (outside the pool) and watches its
+    socket from the event loop, so notifications cost no thread or polling."""
+
+    def __init__(self, dsn, handlers, on_reset):
+        # handlers maps channel -> callback(user_id, kind); on_reset() drops
+        # everything after a reconnect, since notifications may have been missed.
+        self.dsn = dsn
+        self.handlers = handlers
+        self.on_reset = on_reset
+        self._conn = None
+        self._fd = None
+        self._loop = None
+        self._reconnect_task = None
+        self.received = 0
+        self.reconnects = 0
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, application_name=APPLICATION_NAME)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            for channel in self.handlers:
+                cur.execute(f"LISTEN {channel};")
+        return conn
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._conn = await db_executor.run(self._connect)
+        self._fd = self._conn.fileno()
+        self._loop.add_reader(self._fd, self._on_readable)
+        logging.info(f"Listening for cache invalidations on {', '.join(self.handlers)}.")
+
+    def _on_readable(self):
+        try:
+            self._conn.poll()
+        except psycopg2.Error as e:
+            logging.error(f"Invalidation listener lost its connection: {e}")
+            self._drop_connection()
+            self._reconnect_task = self._loop.create_task(self._reconnect())
+            return
+        while self._conn.notifies:
+            notify = self._conn.notifies.pop(0)
+            try:
+                user_id, origin, kind = parse_payload(notify.payload)
+                if origin == APPLICATION_NAME:
+                    continue
+                self.received += 1
+                self.handlers[notify.channel](user_id, kind)
+            except Exception as e:
+                logging.error(f"Could not apply invalidation {notify.channel} '{notify.payload}': {e}")
+
+    def _drop_connection(self):
+        if self._conn is None:
+            return
+        self._loop.remove_reader(self._fd)
+        if not self._conn.closed:
+            self._conn.close()
+        self._conn = None
+
+    async def _reconnect(self):
+        while True:
+            await asyncio.sleep(LISTENER_RECONNECT_DELAY)
+            try:
+                await self.start()
+            except Exception as e:
+                logging.error(f"Invalidation listener reconnect failed: {e}")
+                continue
+            self.reconnects += 1
+            self.on_reset()
+            return
+
+    def retry_later(self):
+        # For a start() that failed: keep trying in the background, the same
+        # way a dropped connection is handled.
+        self._loop = asyncio.get_running_loop()
+        self._reconnect_task = self._loop.create_task(self._reconnect())
+
+    async def stop(self):
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+        self._drop_connection()
+
+    def stats(self):
+        return {'received': self.received, 'reconnects': self.reconnects, 'connected': self._conn is not None}
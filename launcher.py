@@ -0,0 +1,114 @@
+"""Multi-process launcher for a sharded bot.
+
+Splits SHARD_COUNT shards into SHARD_PROCESSES contiguous ranges and runs one
+`main.py bot` process per range (plus one `main.py web` process unless
+LAUNCH_WEB=0), restarting any that exit. With SHARD_COUNT unset or "auto" the
+total is taken from Discord's recommendation for the bot token. With
+METRICS_PORT set, shard process i serves its own /metrics on METRICS_PORT + i.
+
+Usage: SHARD_PROCESSES=4 python launcher.py
+"""
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SHARD_PROCESSES = int(os.environ.get('SHARD_PROCESSES', '1'))
+LAUNCH_WEB = os.environ.get('LAUNCH_WEB', '1') == '1'
+# Gap between process starts so their IDENTIFYs don't trip Discord's
+# per-bot identify rate limit, which each process only enforces locally.
+SHARD_START_DELAY = float(os.environ.get('SHARD_START_DELAY', '5'))
+RESTART_DELAY = float(os.environ.get('RESTART_DELAY', '5'))
+# Base port for the shard processes' /metrics endpoints; process i listens on
+# METRICS_PORT + i. Unset leaves the shard processes without HTTP.
+METRICS_PORT = os.environ.get('METRICS_PORT')
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+
+def recommended_shard_count(token):
+    req = urllib.request.Request(
+        'https://discord.com/api/v10/gateway/bot',
+        headers={'Authorization': f'Bot {token}', 'User-Agent': 'DiscordBot (launcher, 1.0)'},
+    )
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return json.load(resp)['shards']
+
+
+def shard_ranges(shard_count, processes):
+    processes = max(1, min(processes, shard_count))
+    base, extra = divmod(shard_count, processes)
+    ranges, start = [], 0
+    for index in range(processes):
+        size = base + (1 if index < extra else 0)
+        ranges.append((start, start + size - 1))
+        start += size
+    return ranges
+
+
+def build_commands(shard_count):
+    specs = []
+    for index, (first, last) in enumerate(shard_ranges(shard_count, SHARD_PROCESSES)):
+        env = dict(os.environ, SHARD_COUNT=str(shard_count), SHARD_IDS=f"{first}-{last}")
+        if METRICS_PORT:
+            env['METRICS_PORT'] = str(int(METRICS_PORT) + index)
+        specs.append((f"shards {first}-{last}", [sys.executable, MAIN_SCRIPT, 'bot'], env))
+    if LAUNCH_WEB:
+        specs.append(('web', [sys.executable, MAIN_SCRIPT, 'web'], dict(os.environ)))
+    return specs
+
+
+def main():
+    configured = os.environ.get('SHARD_COUNT')
+    if configured and configured != 'auto':
+        shard_count = int(configured)
+    else:
+        shard_count = recommended_shard_count(os.environ['DISCORD_TOKEN'])
+    logging.info(f"Launching {shard_count} shard(s) across {min(SHARD_PROCESSES, shard_count)} process(es).")
+
+    specs = build_commands(shard_count)
+    children = {}
+    stopping = False
+
+    def stop(signum, _frame):
+        nonlocal stopping
+        stopping = True
+        logging.info(f"Received signal {signum}, stopping children.")
+        for process in children.values():
+            process.terminate()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for index, (name, command, env) in enumerate(specs):
+        if index and not stopping:
+            time.sleep(SHARD_START_DELAY)
+        if stopping:
+            break
+        children[name] = subprocess.Popen(command, env=env)
+        logging.info(f"Started {name} (pid {children[name].pid}).")
+
+    while children:
+        time.sleep(1)
+        for name, command, env in specs:
+            process = children.get(name)
+            if process is None or process.poll() is None:
+                continue
+            if stopping:
+                del children[name]
+                continue
+            logging.warning(f"{name} exited with code {process.returncode}; restarting in {RESTART_DELAY}s.")
+            time.sleep(RESTART_DELAY)
+            if stopping:
+                del children[name]
+                continue
+            children[name] = subprocess.Popen(command, env=env)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,39 @@
 import discord
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 import os
-from flask import Flask, request, redirect, session, url_for
-from threading import Thread
+import sys
+from flask import Flask, Response, request, redirect, session, url_for
 import datetime
+import hashlib
 import json
+import time
+from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
-import psycopg2
+from hypercorn.asyncio import serve as hypercorn_serve
+from hypercorn.config import Config as HypercornConfig
 import logging
 import traceback
-import dateparser
 import asyncio
+import caches
+import metrics
+import dateparsing
+import event_render
+import event_views
+import migrations
+import calendar_api
+from event_cache import EventCache
+import push_notifications
+import sharding
+from invalidation import CALENDAR_CHANNEL, TOKEN_CHANNEL, InvalidationListener
+import token_store
+from executors import ALL_EXECUTORS, ExecutorBusy, db_executor, executor_stats, google_executor, parse_executor
+from singleflight import SingleFlight
+from api_gateway import QuotaExceeded
+from calendar_api import calendar_gateway, oauth_gateway
+from token_store import delete_user_token, load_user_token, save_user_token
 
 # ==============================================================================
 # 1. BOT & SERVER SETUP (RENDER)
@@ -31,79 +50,135 @@ if not all([TOKEN, DATABASE_URL, FLASK_SECRET_KEY, RENDER_EXTERNAL_URL]):
 
 intents = discord.Intents.default()
 intents.message_content = True 
-bot = commands.Bot(command_prefix="!", intents=intents) 
+bot = sharding.create_bot(command_prefix="!", intents=intents)
 app = Flask('')
 app.secret_key = FLASK_SECRET_KEY
 
 # ==============================================================================
 # 2. DATABASE SETUP (POSTGRESQL)
 # ==============================================================================
-def init_db():
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS google_tokens (
-                user_id BIGINT PRIMARY KEY,
-                token_json TEXT NOT NULL
-            );
-        """)
-        conn.commit()
-        cur.close()
-        conn.close()
-        logging.info("Database initialized successfully.")
-    except Exception as e:
-        logging.error(f"Error initializing database: {e}")
-
-def save_user_token(user_id, token_json):
-    conn = psycopg2.connect(DATABASE_URL)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO google_tokens (user_id, token_json) VALUES (%s, %s)
-        ON CONFLICT (user_id) DO UPDATE SET token_json = %s;
-    """, (user_id, token_json, token_json))
-    conn.commit()
-    cur.close()
-    conn.close()
-    logging.info(f"Successfully saved token for user {user_id}")
+token_store.configure_token_store(DATABASE_URL)
+token_store.add_token_listener(caches.invalidate_user)
 
 # ==============================================================================
 # 3. GOOGLE CALENDAR SETUP (MULTI-USER WITH POSTGRESQL)
 # ==============================================================================
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 
-def get_calendar_service(user_id):
-    conn = psycopg2.connect(DATABASE_URL)
-    cur = conn.cursor()
-    cur.execute("SELECT token_json FROM google_tokens WHERE user_id = %s;", (user_id,))
-    result = cur.fetchone()
-    
-    if not result:
-        cur.close()
-        conn.close()
-        return None
-
-    creds_json = result[0]
-    creds_info = json.loads(creds_json)
-    creds = Credentials.from_authorized_user_info(creds_info, SCOPES)
+calendar_api.load_discovery_document()
+refresh_flight = SingleFlight()
+
+def refresh_user_credentials(user_id, creds):
+    # Concurrent commands from one user share a single refresh round-trip.
+    def refresh():
+        cached = caches.get_cached_credentials(user_id)
+        if cached and cached.valid:
+            return cached  # Already refreshed by a flight that just finished.
+        try:
+            with metrics.timed('get_user_credentials', 'refresh'):
+                oauth_gateway.call_sync(user_id, lambda: creds.refresh(Request()))
+        except RefreshError as e:
+            if e.retryable:
+                raise  # A transient token endpoint failure; the token is still good.
+            logging.error(f"Refresh token for user {user_id} was rejected, removing it: {e}")
+            delete_user_token(user_id)
+            return None
+        token_store.save_refreshed_token(user_id, creds.to_json())
+        caches.cache_credentials(user_id, creds)
+        return creds
+
+    return refresh_flight.do(int(user_id), refresh)
+
+def load_user_credentials_json(user_id):
+    with metrics.timed('get_user_credentials', 'db_lookup'):
+        return load_user_token(user_id)
+
+def parse_credentials(creds_json):
+    with metrics.timed('get_user_credentials', 'json_parse'):
+        return Credentials.from_authorized_user_info(json.loads(creds_json), SCOPES)
+
+def credentials_from_json(user_id, creds_json, refresh=True):
+    creds = parse_credentials(creds_json)
 
     if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            try:
-                creds.refresh(Request())
-                save_user_token(user_id, creds.to_json())
-            except Exception as e:
-                logging.error(f"Could not refresh token for user {user_id}: {e}")
-                cur.execute("DELETE FROM google_tokens WHERE user_id = %s;", (user_id,))
-                conn.commit()
-                return None
+        if refresh and creds and creds.expired and creds.refresh_token:
+            return refresh_user_credentials(user_id, creds)
         else:
              return None # Needs re-authentication
-    
-    cur.close()
-    conn.close()
-    service = build('calendar', 'v3', credentials=creds)
-    return service
+
+    caches.cache_credentials(user_id, creds)
+    return creds
+
+def refresh_token_ahead_of_expiry(user_id, creds_json):
+    # Refreshes without saving; the background task persists results in one batch.
+    creds = Credentials.from_authorized_user_info(json.loads(creds_json), SCOPES)
+    if not creds.refresh_token:
+        return None
+
+    def refresh():
+        oauth_gateway.call_sync(user_id, lambda: creds.refresh(Request()))
+        caches.cache_credentials(user_id, creds)
+        return creds
+
+    return refresh_flight.do(int(user_id), refresh)
+
+async def get_user_credentials_async(user_id):
+    # Cache hits are served on the event loop without a thread hand-off.
+    creds = caches.get_cached_credentials(user_id)
+    if creds:
+        return creds
+    creds_json = await db_executor.run(load_user_credentials_json, user_id)
+    if not creds_json:
+        return None
+    if calendar_backend.refreshes_credentials:
+        # Expired tokens are refreshed by the backend on first use, through
+        # its own coalesced async path.
+        creds = parse_credentials(creds_json)
+        if creds.valid:
+            caches.cache_credentials(user_id, creds)
+        elif not (creds.expired and creds.refresh_token):
+            return None
+        return creds
+    # A refresh (or waiting on another command's refresh) is Google work and
+    # must not hold one of the few database threads.
+    return await google_executor.run(credentials_from_json, user_id, creds_json)
+
+async def persist_refreshed_credentials(user_id, creds):
+    await token_store.save_refreshed_token_async(user_id, creds.to_json())
+    caches.cache_credentials(user_id, creds)
+
+async def revoke_credentials(user_id):
+    logging.error(f"Refresh token for user {user_id} was rejected, removing it.")
+    await db_executor.run(delete_user_token, user_id)
+
+calendar_backend = calendar_api.create_calendar_backend(
+    on_refresh=persist_refreshed_credentials, on_revoked=revoke_credentials
+)
+event_cache = EventCache(calendar_backend)
+channel_manager = push_notifications.ChannelManager(
+    calendar_backend, event_cache, f"{RENDER_EXTERNAL_URL}{push_notifications.NOTIFICATIONS_PATH}"
+)
+
+# Changes made by other bot/web processes (or straight in the database)
+# arrive as NOTIFYs; this process's own writes are handled by the token listener.
+def on_remote_token_change(user_id, kind):
+    caches.invalidate_user(user_id)
+    if kind == 'account':
+        event_cache.drop(user_id)
+        channel_manager.forget(user_id)
+
+def on_remote_calendar_change(user_id, _kind):
+    event_cache.invalidate(user_id)
+
+def on_invalidation_reset():
+    caches.invalidate_all()
+    event_cache.invalidate_all()
+
+invalidation_listener = InvalidationListener(
+    DATABASE_URL,
+    {TOKEN_CHANNEL: on_remote_token_change, CALENDAR_CHANNEL: on_remote_calendar_change},
+    on_invalidation_reset,
+)
 
 # ==============================================================================
 # 4. WEB ROUTES FOR OAUTH
@@ -112,6 +187,117 @@ def get_calendar_service(user_id):
 def home():
     return "Bot is alive!"
     
+def gateway_latencies():
+    if bot.is_closed() or not bot.is_ready():
+        return
+    if isinstance(bot, commands.AutoShardedBot):
+        for shard_id, latency in bot.latencies:
+            yield (shard_id,), latency
+    else:
+        yield (0,), bot.latency
+
+def executor_values(key):
+    return lambda: (((name,), stats[key]) for name, stats in executor_stats().items())
+
+def cache_stats():
+    return {
+        'credentials': caches.credentials_cache.stats(),
+        'service': caches.service_cache.stats(),
+        'events': event_cache.stats(),
+        'dateparse': dateparsing.cache_stats(),
+        'render': event_render.render_cache.stats(),
+    }
+
+def cache_hit_ratios():
+    for name, stats in cache_stats().items():
+        lookups = stats['hits'] + stats['misses']
+        yield (name,), stats['hits'] / lookups if lookups else None
+
+# Everything below is read from existing stats when /metrics is scraped.
+metrics.CallbackMetric('calendarbot_gateway_latency_seconds', 'Discord gateway heartbeat latency.', ('shard',), gateway_latencies)
+metrics.CallbackMetric(
+    'calendarbot_gateway_events_per_second', 'Gateway events dispatched per second, per shard.', ('shard',),
+    lambda: (((shard_id,), sample['events_per_second']) for shard_id, sample in sharding.shard_metrics.shards.items())
+)
+metrics.CallbackMetric('calendarbot_executor_queue_depth', 'Tasks waiting for a worker.', ('executor',), executor_values('queue_depth'))
+metrics.CallbackMetric('calendarbot_executor_pending', 'Tasks queued or running.', ('executor',), executor_values('pending'))
+metrics.CallbackMetric(
+    'calendarbot_executor_rejected_total', 'Tasks rejected because the queue was full.', ('executor',),
+    executor_values('rejected'), metric_type='counter'
+)
+metrics.CallbackMetric(
+    'calendarbot_db_pool_connections', 'Database pool connections.', ('state',),
+    lambda: [(('in_use',), token_store.pool_stats().get('in_use')), (('max',), token_store.pool_stats().get('size_max'))]
+)
+metrics.CallbackMetric(
+    'calendarbot_db_pool_checkouts_total', 'Database connection checkouts.', (),
+    lambda: [((), token_store.pool_stats().get('checkouts'))], metric_type='counter'
+)
+metrics.CallbackMetric(
+    'calendarbot_db_pool_timeouts_total', 'Checkouts that gave up waiting for a connection.', (),
+    lambda: [((), token_store.pool_stats().get('timeouts'))], metric_type='counter'
+)
+metrics.CallbackMetric(
+    'calendarbot_db_pool_wait_seconds_total', 'Time spent waiting for a database connection.', (),
+    lambda: [((), token_store.pool_stats().get('wait_seconds_total'))], metric_type='counter'
+)
+metrics.CallbackMetric('calendarbot_cache_hit_ratio', 'Cache hits per lookup since start.', ('cache',), cache_hit_ratios)
+metrics.CallbackMetric(
+    'calendarbot_cache_entries', 'Entries currently cached.', ('cache',),
+    lambda: (((name,), stats['entries']) for name, stats in cache_stats().items())
+)
+metrics.CallbackMetric(
+    'calendarbot_api_budget_remaining', 'Requests left in the global Google API bucket.', ('gateway',),
+    lambda: (((gateway.name,), gateway.stats()['remaining']) for gateway in (calendar_gateway, oauth_gateway))
+)
+metrics.CallbackMetric(
+    'calendarbot_api_budget_capacity', 'Size of the global Google API bucket.', ('gateway',),
+    lambda: (((gateway.name,), gateway.stats()['capacity']) for gateway in (calendar_gateway, oauth_gateway))
+)
+metrics.CallbackMetric(
+    'calendarbot_token_refreshes_total', 'Token refreshes, by whether they ran or joined one in flight.', ('result',),
+    lambda: (((result,), count) for result, count in refresh_flight.stats().items()), metric_type='counter'
+)
+metrics.CallbackMetric(
+    'calendarbot_token_writes_pending', 'Refreshed tokens waiting for the write-behind flush.', (),
+    lambda: [((), token_store.write_behind.stats()['pending'])]
+)
+metrics.CallbackMetric(
+    'calendarbot_token_writes_total', 'Write-behind token writes by stage.', ('stage',),
+    lambda: (((stage,), token_store.write_behind.stats()[stage]) for stage in ('enqueued', 'coalesced', 'flushes', 'rows_written')),
+    metric_type='counter'
+)
+metrics.CallbackMetric(
+    'calendarbot_push_channels', 'Push channels known to this process.', (),
+    lambda: [((), channel_manager.stats()['channels'])]
+)
+metrics.CallbackMetric(
+    'calendarbot_push_notifications_total', 'Push notifications received, by outcome.', ('result',),
+    lambda: [(('accepted',), channel_manager.stats()['notifications']), (('rejected',), channel_manager.stats()['rejected'])],
+    metric_type='counter'
+)
+metrics.CallbackMetric(
+    'calendarbot_invalidations_received_total', 'Cache invalidation NOTIFYs received.', (),
+    lambda: [((), invalidation_listener.stats()['received'])], metric_type='counter'
+)
+metrics.CallbackMetric(
+    'calendarbot_invalidation_listener_reconnects_total', 'Times the invalidation listener reconnected.', (),
+    lambda: [((), invalidation_listener.stats()['reconnects'])], metric_type='counter'
+)
+metrics.CallbackMetric(
+    'calendarbot_invalidation_listener_connected', 'Whether the invalidation listener is connected.', (),
+    lambda: [((), int(invalidation_listener.stats()['connected']))]
+)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# Bot-only processes serve just /metrics, on METRICS_PORT, since the shard and
+# command metrics only exist in the process that runs the shards.
+metrics_app = Flask('metrics')
+metrics_app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
+
 @app.route('/connect_google')
 def connect_google():
     user_id = request.args.get('user_id')
@@ -136,6 +322,13 @@ def connect_google():
 
 @app.route('/oauth2callback')
 def oauth2callback():
+    started = time.perf_counter()
+    response = complete_oauth()
+    status = response[1] if isinstance(response, tuple) else 200
+    metrics.oauth_callback_seconds.observe((str(status),), time.perf_counter() - started)
+    return response
+
+def complete_oauth():
     try:
         state = session['state']
         redirect_uri = f"{RENDER_EXTERNAL_URL}{url_for('oauth2callback')}"
@@ -147,7 +340,10 @@ def oauth2callback():
             redirect_uri=redirect_uri
         )
         authorization_response = request.url
-        flow.fetch_token(authorization_response=authorization_response)
+        # The authorization code is single-use, so only a rate-limit refusal is retried.
+        oauth_gateway.call_sync(
+            None, lambda: flow.fetch_token(authorization_response=authorization_response), retry_server_errors=False
+        )
         
         credentials = flow.credentials
         user_id = session.get('user_id')
@@ -155,26 +351,140 @@ def oauth2callback():
         if not user_id:
             return "<h1>Authentication failed: User session not found.</h1>", 400
 
+        # Must happen while the old token is still stored: only the account
+        # that created the channel can stop it.
+        stop_push_channel(user_id)
         save_user_token(user_id, credentials.to_json())
+        # A reconnect may be a different Google account; don't serve its old events.
+        event_cache.forget(user_id)
         
         return "<h1>Authentication successful!</h1><p>Your calendar is now connected. You can close this window.</p>"
     except Exception as e:
         logging.error(f"An error occurred in the OAuth callback:\n{traceback.format_exc()}")
         return "<h1>An error occurred during authentication.</h1><p>Please try again.</p>", 500
 
+CHANNEL_STOP_TIMEOUT = float(os.environ.get('CHANNEL_STOP_TIMEOUT', '10'))
+
+async def stop_user_channel(user_id):
+    creds = await get_user_credentials_async(user_id)
+    await channel_manager.stop(user_id, creds)
+
+def stop_push_channel(user_id):
+    # Called from Flask threads; the backend's clients belong to the serving loop.
+    loop = app.config.get('EVENT_LOOP')
+    if loop is None:
+        # Served by an external WSGI server; the channel just runs out its TTL.
+        token_store.delete_calendar_channel(user_id)
+        channel_manager.forget(user_id)
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(stop_user_channel(user_id), loop).result(CHANNEL_STOP_TIMEOUT)
+    except Exception as e:
+        logging.warning(f"Could not stop push channel for user {user_id}: {e}")
+        token_store.delete_calendar_channel(user_id)
+        channel_manager.forget(user_id)
+
+@app.route(push_notifications.NOTIFICATIONS_PATH, methods=['POST'])
+def calendar_notifications():
+    # Google only needs a 2xx back; the cache resyncs on the user's next /events.
+    status = channel_manager.handle_notification(request.headers)
+    return "", status
+
 # ==============================================================================
 # 5. BOT EVENTS & SLASH COMMANDS
 # ==============================================================================
-@bot.event
-async def on_ready():
-    logging.info(f'Success! We have logged in as {bot.user}')
-    init_db()
+BUSY_RETRY_ATTEMPTS = int(os.environ.get('BUSY_RETRY_ATTEMPTS', '3'))
+BUSY_RETRY_DELAY = float(os.environ.get('BUSY_RETRY_DELAY', '2'))
+BUSY_GIVE_UP_MESSAGE = "⏳ I'm overloaded right now. Please try again in a minute."
+QUOTA_MESSAGE = "⏳ Google Calendar is rate-limiting requests right now. Please try again in a minute."
+
+async def with_backpressure(interaction, operation):
+    # Retries work rejected by a saturated executor, telling the user once.
+    for attempt in range(BUSY_RETRY_ATTEMPTS):
+        try:
+            return await operation()
+        except ExecutorBusy as e:
+            if attempt == BUSY_RETRY_ATTEMPTS - 1:
+                raise
+            logging.warning(f"{e}; retrying for user {interaction.user.id}")
+            if attempt == 0:
+                # Edits the deferred reply in place; a followup here would take
+                # its place, and later followups would then be posted publicly.
+                await interaction.edit_original_response(content="⏳ I'm busy right now, retrying in a moment...")
+            await asyncio.sleep(BUSY_RETRY_DELAY * (attempt + 1))
+
+FORCE_COMMAND_SYNC = os.environ.get('FORCE_COMMAND_SYNC', '0') == '1'
+
+def command_tree_hash():
+    payload = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands()), key=lambda c: c['name'])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+async def sync_commands(force=False):
+    # Global sync hits a rate-limited bulk-overwrite endpoint, so only do it
+    # when the command definitions actually changed since the last sync.
+    state_key = f"command_tree_hash:{bot.application_id}"
+    tree_hash = command_tree_hash()
+    if not force and await db_executor.run(token_store.get_bot_state, state_key) == tree_hash:
+        logging.info("Command tree unchanged since last sync; skipping global sync.")
+        return None
+    synced = await bot.tree.sync()
+    await db_executor.run(token_store.set_bot_state, state_key, tree_hash)
+    logging.info(f"Synced {len(synced)} global command(s).")
+    return synced
+
+async def setup_hook():
+    # Runs once per process before the gateway connects; on_ready fires again
+    # on every reconnect, so nothing slow or one-off belongs there.
     try:
-        # Syncing commands globally now, so they work in all servers.
-        synced = await bot.tree.sync()
-        logging.info(f"Synced {len(synced)} global command(s).")
+        await db_executor.run(migrations.run_migrations)
+    except Exception as e:
+        logging.error(f"Error initializing database: {e}")
+        raise
+    await parse_executor.run(dateparsing.warm_up)
+    try:
+        await invalidation_listener.start()
+    except Exception as e:
+        logging.error(f"Could not start the cache invalidation listener, retrying in the background: {e}")
+        invalidation_listener.retry_later()
+    try:
+        await sync_commands(force=FORCE_COMMAND_SYNC)
     except Exception as e:
         logging.error(f"Failed to sync global commands: {e}")
+    if WARMUP_USERS > 0:
+        # Runs alongside the gateway login rather than delaying it.
+        bot.warmup_task = asyncio.create_task(warm_caches())
+    # Activity is buffered per process, so every process flushes its own.
+    flush_user_activity.start()
+    sample_shard_metrics.start()
+    if not sharding.owns_primary_shard(bot):
+        return
+    proactive_token_refresh.start()
+    if push_notifications.PUSH_NOTIFICATIONS_ENABLED:
+        renew_push_channels.start()
+
+bot.setup_hook = setup_hook
+
+@bot.listen()
+async def on_interaction(interaction):
+    if interaction.type == discord.InteractionType.application_command:
+        metrics.commands_total.inc((interaction.data.get('name', 'unknown'),))
+
+@bot.tree.error
+async def on_app_command_error(interaction, error):
+    # Only reached by commands that don't handle their own errors.
+    metrics.command_errors_total.inc((interaction.data.get('name', 'unknown'),))
+    logging.error(f"Unhandled error in /{interaction.data.get('name')}:", exc_info=error)
+
+@bot.event
+async def on_ready():
+    logging.info(f'Success! We have logged in as {bot.user}')
+
+@bot.command(name="sync")
+@commands.is_owner()
+async def force_sync(ctx):
+    # Manual override for when Discord's copy of the commands drifted anyway.
+    synced = await sync_commands(force=True)
+    await ctx.send(f"Synced {len(synced)} global command(s).")
 
 @bot.tree.command(name="connect", description="Connect or re-authorize your Google Calendar.")
 async def connect(interaction: discord.Interaction):
@@ -187,61 +497,92 @@ async def connect(interaction: discord.Interaction):
     except discord.Forbidden:
         await interaction.followup.send("I couldn't send you a DM. Please check your server privacy settings.")
 
-@bot.tree.command(name="events", description="Shows your next 10 upcoming Google Calendar events.")
-async def events(interaction: discord.Interaction):
+@bot.tree.command(name="events", description="Shows your upcoming Google Calendar events.")
+@app_commands.describe(period="Which events to list", days="How many days ahead, for 'Next N days'")
+@app_commands.choices(period=[
+    app_commands.Choice(name="Upcoming", value="upcoming"),
+    app_commands.Choice(name="Today", value="today"),
+    app_commands.Choice(name="This week", value="week"),
+    app_commands.Choice(name="Next N days", value="days"),
+])
+async def events(
+    interaction: discord.Interaction, period: str = "upcoming",
+    days: app_commands.Range[int, 1, event_views.EVENTS_MAX_DAYS] = 7
+):
     await interaction.response.defer(ephemeral=True)
+    token_store.record_user_activity(interaction.user.id)
     
     try:
-        service = await asyncio.to_thread(get_calendar_service, interaction.user.id)
+        with metrics.timed('events', 'credentials'):
+            creds = await with_backpressure(interaction, lambda: get_user_credentials_async(interaction.user.id))
         
-        if not service:
-            await interaction.followup.send(f"You haven't connected your Google Calendar yet! Please use the `/connect` command.")
+        if not creds:
+            await interaction.followup.send(f"You haven't connected your Google Calendar yet! Please use the `/connect` command.", ephemeral=True)
             return
 
-        now = datetime.datetime.utcnow().isoformat() + 'Z'
-        
-        events_result = await asyncio.to_thread(
-            service.events().list(
-                calendarId='primary', timeMin=now,
-                maxResults=10, singleEvents=True,
-                orderBy='startTime'
-            ).execute
-        )
-        
-        events = events_result.get('items', [])
+        time_min, time_max, title = event_views.period_window(period, days, datetime.datetime.now(datetime.timezone.utc))
+
+        async def load_first_page():
+            # Later pages are only fetched when the user clicks Next.
+            pages = event_cache.iter_range(
+                interaction.user.id, creds, time_min, time_max, page_size=event_views.EVENTS_PAGE_SIZE
+            )
+            pager = event_views.EventPager(pages)
+            await pager.get(0)
+            # Read once the first page has synced; every page of this view is
+            # keyed by it, so later pages can't mix event sets.
+            return pager, event_cache.version(interaction.user.id)
+
+        with metrics.timed('events', 'fetch_events'):
+            pager, version = await with_backpressure(interaction, load_first_page)
 
-        if not events:
-            await interaction.followup.send('You have no upcoming events found.')
+        if not pager.loaded:
+            await interaction.followup.send(event_views.empty_message(period, days), ephemeral=True)
             return
         
-        response = "📅 **Your upcoming events:**\n\n"
-        for event in events:
-            start = event['start'].get('dateTime', event['start'].get('date'))
-            if 'T' in start:
-                start_formatted = datetime.datetime.fromisoformat(start.replace('Z', '+00:00')).strftime('%A, %B %d at %I:%M %p')
-            else:
-                start_formatted = datetime.datetime.fromisoformat(start).strftime('%A, %B %d (All Day)')
-            response += f"**- {event['summary']}** on {start_formatted}\n"
+        with metrics.timed('events', 'render'):
+            # Same minute, same range, same events: the pages are reused as rendered.
+            cache_key = (interaction.user.id, period, days, time_min.replace(second=0, microsecond=0), version)
+            view = event_views.EventsView(interaction.user.id, pager, title, cache_key)
+            embed = view.embed()
         
-        await interaction.followup.send(response)
+        with metrics.timed('events', 'followup'):
+            view.message = await interaction.followup.send(embed=embed, view=view, wait=True, ephemeral=True)
 
+        if push_notifications.PUSH_NOTIFICATIONS_ENABLED:
+            # After replying, so watch registration never delays the response.
+            try:
+                await channel_manager.ensure_channel(interaction.user.id, creds)
+            except Exception as e:
+                logging.warning(f"Could not register push channel for user {interaction.user.id}: {e}")
+
+    except ExecutorBusy:
+        metrics.command_errors_total.inc(('events',))
+        await interaction.followup.send(BUSY_GIVE_UP_MESSAGE, ephemeral=True)
+    except QuotaExceeded:
+        metrics.command_errors_total.inc(('events',))
+        await interaction.followup.send(QUOTA_MESSAGE, ephemeral=True)
     except Exception as e:
+        metrics.command_errors_total.inc(('events',))
         logging.error(f"An error occurred in the /events command:\n{traceback.format_exc()}")
-        await interaction.followup.send(f"An error occurred while trying to fetch your calendar events.")
+        await interaction.followup.send(f"An error occurred while trying to fetch your calendar events.", ephemeral=True)
 
 @bot.tree.command(name="addevent", description="Adds a new event to your primary Google Calendar.")
 async def addevent(interaction: discord.Interaction, name: str, when: str, duration_minutes: int = 60):
     await interaction.response.defer(ephemeral=True)
+    token_store.record_user_activity(interaction.user.id)
 
     try:
-        service = await asyncio.to_thread(get_calendar_service, interaction.user.id)
-        if not service:
-            await interaction.followup.send("You need to connect your calendar first using `/connect`.")
+        with metrics.timed('addevent', 'credentials'):
+            creds = await with_backpressure(interaction, lambda: get_user_credentials_async(interaction.user.id))
+        if not creds:
+            await interaction.followup.send("You need to connect your calendar first using `/connect`.", ephemeral=True)
             return
 
-        start_time = await asyncio.to_thread(dateparser.parse, when)
+        with metrics.timed('addevent', 'parse_date'):
+            start_time = await with_backpressure(interaction, lambda: parse_executor.run(dateparsing.parse_when, when))
         if not start_time:
-            await interaction.followup.send("Sorry, I couldn't understand that date and time. Please try again (e.g., 'tomorrow at 3pm').")
+            await interaction.followup.send("Sorry, I couldn't understand that date and time. Please try again (e.g., 'tomorrow at 3pm').", ephemeral=True)
             return
 
         end_time = start_time + datetime.timedelta(minutes=duration_minutes)
@@ -254,25 +595,215 @@ async def addevent(interaction: discord.Interaction, name: str, when: str, durat
             'end': {'dateTime': end_iso, 'timeZone': 'UTC'},
         }
 
-        created_event = await asyncio.to_thread(
-            service.events().insert(calendarId='primary', body=event).execute
-        )
+        with metrics.timed('addevent', 'insert_event'):
+            created_event = await with_backpressure(
+                interaction, lambda: calendar_backend.insert_event(
+                    interaction.user.id, creds, 'primary', event, fields=calendar_api.INSERTED_EVENT_FIELDS
+                )
+            )
         
+        event_cache.invalidate(interaction.user.id)
         event_link = created_event.get('htmlLink')
-        await interaction.followup.send(f"✅ Event created successfully! You can view it here: {event_link}")
+        with metrics.timed('addevent', 'followup'):
+            await interaction.followup.send(f"✅ Event created successfully! You can view it here: {event_link}", ephemeral=True)
         
+    except ExecutorBusy:
+        metrics.command_errors_total.inc(('addevent',))
+        await interaction.followup.send(BUSY_GIVE_UP_MESSAGE, ephemeral=True)
+    except QuotaExceeded:
+        metrics.command_errors_total.inc(('addevent',))
+        await interaction.followup.send(QUOTA_MESSAGE, ephemeral=True)
     except Exception as e:
+        metrics.command_errors_total.inc(('addevent',))
         logging.error(f"Failed to create event for user {interaction.user.id}:\n{traceback.format_exc()}")
-        await interaction.followup.send("Sorry, an error occurred while creating the event.")
-
-# The server-specific sync command is no longer needed for a public bot.
+        await interaction.followup.send("Sorry, an error occurred while creating the event.", ephemeral=True)
 
 # ==============================================================================
-# 6. START THE BOT IN A BACKGROUND THREAD
+# 6. BACKGROUND TASKS
 # ==============================================================================
-def run_bot():
-    bot.run(TOKEN)
+TOKEN_REFRESH_INTERVAL = int(os.environ.get('TOKEN_REFRESH_INTERVAL', '300'))
+TOKEN_REFRESH_WINDOW = int(os.environ.get('TOKEN_REFRESH_WINDOW', '900'))
+TOKEN_REFRESH_BATCH_SIZE = int(os.environ.get('TOKEN_REFRESH_BATCH_SIZE', '100'))
+TOKEN_REFRESH_RATE = float(os.environ.get('TOKEN_REFRESH_RATE', '5'))  # refreshes per second
+TOKEN_REFRESH_ACTIVE_DAYS = int(os.environ.get('TOKEN_REFRESH_ACTIVE_DAYS', '30'))
+
+@tasks.loop(seconds=TOKEN_REFRESH_INTERVAL)
+async def proactive_token_refresh():
+    # The window must be wider than the interval so no token can expire between scans.
+    try:
+        expiring = await db_executor.run(
+            token_store.find_expiring_tokens, TOKEN_REFRESH_WINDOW, TOKEN_REFRESH_BATCH_SIZE,
+            TOKEN_REFRESH_ACTIVE_DAYS
+        )
+    except Exception as e:
+        logging.error(f"Could not scan for expiring tokens: {e}")
+        return
+
+    refreshed = []
+    for user_id, creds_json in expiring:
+        try:
+            creds = await google_executor.run(refresh_token_ahead_of_expiry, user_id, creds_json)
+            if creds:
+                refreshed.append((user_id, creds))
+        except RefreshError as e:
+            if e.retryable:
+                logging.warning(f"Background refresh for user {user_id} will be retried: {e}")
+            else:
+                logging.warning(f"Refresh token for user {user_id} was rejected, removing it: {e}")
+                await db_executor.run(delete_user_token, user_id)
+        except Exception as e:
+            logging.error(f"Background refresh failed for user {user_id}: {e}")
+        # Stay well under Google's token endpoint rate limits.
+        await asyncio.sleep(1 / TOKEN_REFRESH_RATE)
+
+    if not refreshed:
+        return
+    try:
+        # Conditional on the stored grant: a user who reconnected or was
+        # removed since their refresh keeps the newer state.
+        updated = set(await db_executor.run(
+            token_store.update_refreshed_tokens, [(user_id, creds.to_json()) for user_id, creds in refreshed]
+        ))
+    except Exception as e:
+        logging.error(f"Could not save {len(refreshed)} refreshed token(s): {e}")
+        return
+    # Saving invalidates the cache; put the fresh credentials straight back.
+    for user_id, creds in refreshed:
+        if user_id in updated:
+            caches.cache_credentials(user_id, creds)
+        else:
+            caches.invalidate_user(user_id)
+    logging.info(f"Proactively refreshed {len(updated)} of {len(refreshed)} token(s).")
+
+USER_ACTIVITY_FLUSH_INTERVAL = int(os.environ.get('USER_ACTIVITY_FLUSH_INTERVAL', '60'))
+
+@tasks.loop(seconds=USER_ACTIVITY_FLUSH_INTERVAL)
+async def flush_user_activity():
+    try:
+        await db_executor.run(token_store.flush_user_activity)
+    except Exception as e:
+        logging.error(f"Could not record user activity: {e}")
+
+WARMUP_USERS = int(os.environ.get('WARMUP_USERS', '200'))
+WARMUP_CONCURRENCY = int(os.environ.get('WARMUP_CONCURRENCY', '8'))
+
+async def warm_caches():
+    # Preloads credentials and Calendar services for the most recently active
+    # users so the first commands after a deploy skip the cold path.
+    started = time.perf_counter()
+    try:
+        recent = await db_executor.run(token_store.find_recently_active_users, WARMUP_USERS)
+    except Exception as e:
+        logging.error(f"Could not load users for cache warm-up: {e}")
+        return
+    limit = asyncio.Semaphore(WARMUP_CONCURRENCY)
+
+    async def warm(user_id, creds_json):
+        async with limit:
+            try:
+                # Expired tokens are left for the first command (or the
+                # proactive refresh) rather than refreshed in bulk at startup.
+                creds = await google_executor.run(credentials_from_json, user_id, creds_json, False)
+                if creds:
+                    await calendar_backend.warm_up(user_id, creds)
+                    return True
+            except Exception as e:
+                logging.warning(f"Cache warm-up failed for user {user_id}: {e}")
+            return False
+
+    results = await asyncio.gather(*(warm(user_id, creds_json) for user_id, creds_json in recent))
+    logging.info(
+        f"Warmed caches for {sum(results)}/{len(recent)} recent user(s) "
+        f"in {time.perf_counter() - started:.2f}s."
+    )
 
-bot_thread = Thread(target=run_bot)
-bot_thread.start()
+@tasks.loop(seconds=push_notifications.CHANNEL_RENEW_INTERVAL)
+async def renew_push_channels():
+    try:
+        await channel_manager.renew_expiring(get_user_credentials_async)
+    except Exception as e:
+        logging.error(f"Could not renew push channels: {e}")
+
+SHARD_METRICS_INTERVAL = int(os.environ.get('SHARD_METRICS_INTERVAL', '60'))
+
+@tasks.loop(seconds=SHARD_METRICS_INTERVAL)
+async def sample_shard_metrics():
+    for shard_id, sample in sharding.shard_metrics.sample(bot).items():
+        rate = sample['events_per_second']
+        logging.debug(
+            f"Shard {shard_id}: latency {sample['latency'] * 1000:.0f} ms, "
+            f"{'n/a' if rate is None else f'{rate:.1f}'} events/s"
+        )
 
+@sample_shard_metrics.before_loop
+async def before_sample_shard_metrics():
+    await bot.wait_until_ready()
+
+# ==============================================================================
+# 7. ENTRY POINT
+# ==============================================================================
+# Modes (first CLI argument, or RUN_MODE):
+#   all - bot and OAuth web routes in one process, sharing one event loop
+#   bot - Discord gateway only
+#   web - web routes only; also importable as `gunicorn main:app`, which never
+#         starts a gateway session, so web workers can scale out freely
+RUN_MODE = os.environ.get('RUN_MODE', 'all')
+WEB_PORT = int(os.environ.get('PORT', '8080'))
+# Unset: bot mode serves no HTTP at all. launcher.py gives each shard process
+# its own port, METRICS_PORT + the process index.
+METRICS_PORT = os.environ.get('METRICS_PORT')
+
+async def serve_web(shutdown_event=None):
+    config = HypercornConfig()
+    config.bind = [f"0.0.0.0:{WEB_PORT}"]
+    app.config['EVENT_LOOP'] = asyncio.get_running_loop()
+    # Hypercorn runs the Flask (WSGI) app on worker threads; the loop stays free.
+    trigger = shutdown_event.wait if shutdown_event else None
+    await hypercorn_serve(app, config, mode='wsgi', shutdown_trigger=trigger)
+
+async def shutdown():
+    await invalidation_listener.stop()
+    await calendar_backend.close()
+    for executor in ALL_EXECUTORS:
+        executor.shutdown()
+    token_store.close_token_store()
+
+async def serve_metrics(shutdown_event):
+    config = HypercornConfig()
+    config.bind = [f"0.0.0.0:{METRICS_PORT}"]
+    await hypercorn_serve(metrics_app, config, mode='wsgi', shutdown_trigger=shutdown_event.wait)
+
+async def run_bot(with_web=False):
+    web_shutdown = asyncio.Event()
+    if with_web:
+        web = asyncio.create_task(serve_web(web_shutdown))
+    elif METRICS_PORT:
+        web = asyncio.create_task(serve_metrics(web_shutdown))
+    else:
+        web = None
+    try:
+        async with bot:
+            await bot.start(TOKEN)
+    finally:
+        if web:
+            web_shutdown.set()
+            await web
+        await shutdown()
+
+async def run_web():
+    try:
+        await db_executor.run(migrations.run_migrations)
+        await serve_web()
+    finally:
+        await shutdown()
+
+if __name__ == '__main__':
+    mode = sys.argv[1] if len(sys.argv) > 1 else RUN_MODE
+    if mode == 'bot':
+        asyncio.run(run_bot())
+    elif mode == 'web':
+        asyncio.run(run_web())
+    elif mode == 'all':
+        asyncio.run(run_bot(with_web=True))
+    else:
+        raise SystemExit(f"Unknown mode '{mode}'; expected one of: all, bot, web")
@@ -0,0 +1,191 @@
+import logging
+import math
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# ==============================================================================
+# 1. LOCK-FREE ACCUMULATORS
+# ==============================================================================
+# Quantiles are computed over the most recent METRICS_WINDOW samples per series.
+METRICS_WINDOW = int(os.environ.get('METRICS_WINDOW', '1024'))
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class _ThreadCells:
+    """Per-thread accumulators. Each thread only ever writes its own dict, so
+    recording takes no lock; a scrape adds all the dicts up."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._cells = []
+
+    def cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = defaultdict(float)
+            self._cells.append(cell)
+            return cell
+
+    def totals(self):
+        totals = defaultdict(float)
+        for cell in list(self._cells):
+            for key, value in list(cell.items()):
+                totals[key] += value
+        return totals
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    value = float(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+# ==============================================================================
+# 2. METRIC TYPES
+# ==============================================================================
+_registry = []
+
+
+class Summary:
+    """Latency summary: cumulative _count/_sum plus p50/p95/p99 over a sliding
+    window of recent observations."""
+
+    def __init__(self, name, documentation, labelnames=(), window=METRICS_WINDOW):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.window = window
+        self._samples = {}
+        self._totals = _ThreadCells()
+        _registry.append(self)
+
+    def observe(self, labels, seconds):
+        samples = self._samples.get(labels)
+        if samples is None:
+            samples = self._samples.setdefault(labels, deque(maxlen=self.window))
+        samples.append(seconds)
+        cell = self._totals.cell()
+        cell[(labels, 'count')] += 1
+        cell[(labels, 'sum')] += seconds
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(labels, time.perf_counter() - started)
+
+    def quantiles(self, labels):
+        samples = sorted(self._samples.get(labels, ()))
+        if not samples:
+            return {q: None for q in QUANTILES}
+        return {q: samples[min(int(q * len(samples)), len(samples) - 1)] for q in QUANTILES}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} summary"]
+        totals = self._totals.totals()
+        for labels in sorted(self._samples):
+            for q, value in self.quantiles(labels).items():
+                label_text = _format_labels(self.labelnames + ('quantile',), labels + (q,))
+                lines.append(f"{self.name}{label_text} {_format_value(value)}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(totals[(labels, 'sum')])}")
+            lines.append(f"{self.name}_count{label_text} {_format_value(totals[(labels, 'count')])}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._totals = _ThreadCells()
+        _registry.append(self)
+
+    def inc(self, labels=(), amount=1):
+        self._totals.cell()[labels] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._totals.totals().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class CallbackMetric:
+    """Values read from existing stats at scrape time, so nothing is recorded
+    on the hot path. collect() yields (labels, value) pairs."""
+
+    def __init__(self, name, documentation, labelnames, collect, metric_type='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self.metric_type = metric_type
+        _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        try:
+            samples = list(self.collect())
+        except Exception as e:
+            logging.warning(f"Could not collect metric {self.name}: {e}")
+            return lines
+        for labels, value in samples:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+def render_metrics():
+    # Prometheus text exposition format, version 0.0.4.
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# ==============================================================================
+# 3. REQUEST STAGE TIMINGS
+# ==============================================================================
+stage_seconds = Summary(
+    'calendarbot_stage_seconds', 'Time spent in each stage of a command or lookup.', ('operation', 'stage')
+)
+
+
+def timed(operation, stage):
+    return stage_seconds.time(operation, stage)
+
+# ==============================================================================
+# 4. SHARED COUNTERS
+# ==============================================================================
+commands_total = Counter('calendarbot_commands_total', 'Slash commands invoked.', ('command',))
+command_errors_total = Counter('calendarbot_command_errors_total', 'Slash commands that failed.', ('command',))
+google_api_calls_total = Counter(
+    'calendarbot_google_api_calls_total', 'Calendar API calls by backend and HTTP status.', ('backend', 'status')
+)
+oauth_callback_seconds = Summary(
+    'calendarbot_oauth_callback_seconds', 'Time to complete the OAuth callback.', ('status',)
+)
+api_retries_total = Counter('calendarbot_api_retries_total', 'Google API calls retried after backoff.', ('gateway', 'reason'))
+api_rejected_total = Counter(
+    'calendarbot_api_rejected_total', 'Google API calls refused because the budget was exhausted.', ('gateway',)
+)
+api_throttled_seconds_total = Counter(
+    'calendarbot_api_throttled_seconds_total', 'Time calls waited for a rate-limit token.', ('gateway',)
+)
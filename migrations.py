@@ -0,0 +1,149 @@
+import logging
+
+import token_store
+
+# ==============================================================================
+# 1. VERSIONED SCHEMA MIGRATIONS
+# ==============================================================================
+# Append new migrations to the end; never edit or reorder applied ones. Early
+# migrations use IF NOT EXISTS because databases created before migrations
+# were tracked already contain their tables.
+MIGRATIONS = [
+    (1, 'create google_tokens', """
+        CREATE TABLE IF NOT EXISTS google_tokens (
+            user_id BIGINT PRIMARY KEY,
+            token_json TEXT NOT NULL
+        );
+    """),
+    (2, 'google_tokens expiry column', """
+        ALTER TABLE google_tokens ADD COLUMN IF NOT EXISTS expiry TIMESTAMPTZ;
+        CREATE INDEX IF NOT EXISTS google_tokens_expiry_idx ON google_tokens (expiry);
+        UPDATE google_tokens SET expiry = (token_json::json->>'expiry')::timestamptz
+        WHERE expiry IS NULL AND token_json::json->>'expiry' IS NOT NULL;
+    """),
+    (3, 'create event_sync_state', """
+        CREATE TABLE IF NOT EXISTS event_sync_state (
+            user_id BIGINT PRIMARY KEY,
+            sync_token TEXT,
+            events JSONB NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """),
+    (4, 'create calendar_channels', """
+        CREATE TABLE IF NOT EXISTS calendar_channels (
+            user_id BIGINT PRIMARY KEY,
+            channel_id TEXT NOT NULL UNIQUE,
+            resource_id TEXT NOT NULL,
+            token TEXT NOT NULL,
+            expiration TIMESTAMPTZ NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS calendar_channels_expiration_idx ON calendar_channels (expiration);
+    """),
+    (5, 'create bot_state', """
+        CREATE TABLE bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """),
+    (6, 'notify on google_tokens changes', """
+        CREATE OR REPLACE FUNCTION notify_google_tokens_changed() RETURNS trigger AS $$
+        DECLARE
+            kind TEXT;
+            changed_user_id BIGINT;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                changed_user_id := OLD.user_id;
+                kind := 'account';
+            ELSE
+                changed_user_id := NEW.user_id;
+                -- A new refresh token means the user re-authorized, possibly as
+                -- a different Google account; a plain refresh keeps the old one.
+                IF TG_OP = 'INSERT' OR (OLD.token_json::json->>'refresh_token')
+                        IS DISTINCT FROM (NEW.token_json::json->>'refresh_token') THEN
+                    kind := 'account';
+                ELSE
+                    kind := 'token';
+                END IF;
+            END IF;
+            PERFORM pg_notify(
+                'google_tokens_changed',
+                changed_user_id || ':' || current_setting('application_name') || ':' || kind
+            );
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER google_tokens_notify
+        AFTER INSERT OR UPDATE OR DELETE ON google_tokens
+        FOR EACH ROW EXECUTE FUNCTION notify_google_tokens_changed();
+    """),
+    (7, 'google_tokens jsonb payload, scopes and last_used_at', """
+        ALTER TABLE google_tokens ALTER COLUMN token_json TYPE JSONB USING token_json::jsonb;
+        ALTER TABLE google_tokens ADD COLUMN scopes TEXT[];
+        ALTER TABLE google_tokens ADD COLUMN last_used_at TIMESTAMPTZ NOT NULL DEFAULT now();
+        UPDATE google_tokens SET scopes = ARRAY(SELECT jsonb_array_elements_text(token_json->'scopes'))
+        WHERE jsonb_typeof(token_json->'scopes') = 'array';
+        CREATE INDEX google_tokens_scopes_idx ON google_tokens USING GIN (scopes);
+        CREATE INDEX google_tokens_last_used_at_idx ON google_tokens (last_used_at DESC);
+
+        CREATE OR REPLACE FUNCTION notify_google_tokens_changed() RETURNS trigger AS $$
+        DECLARE
+            kind TEXT;
+            changed_user_id BIGINT;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                changed_user_id := OLD.user_id;
+                kind := 'account';
+            ELSE
+                changed_user_id := NEW.user_id;
+                -- Touching last_used_at alone changes nothing other processes cache.
+                IF TG_OP = 'UPDATE' AND OLD.token_json = NEW.token_json THEN
+                    RETURN NULL;
+                END IF;
+                IF TG_OP = 'INSERT' OR (OLD.token_json->>'refresh_token')
+                        IS DISTINCT FROM (NEW.token_json->>'refresh_token') THEN
+                    kind := 'account';
+                ELSE
+                    kind := 'token';
+                END IF;
+            END IF;
+            PERFORM pg_notify(
+                'google_tokens_changed',
+                changed_user_id || ':' || current_setting('application_name') || ':' || kind
+            );
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """),
+]
+
+# Arbitrary constant; serializes migrations across processes starting together.
+MIGRATION_LOCK_ID = 727_001
+
+
+def run_migrations():
+    with token_store.connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+        """)
+
+    applied = 0
+    for version, name, sql in MIGRATIONS:
+        # One transaction per migration; the lock is released at commit.
+        with token_store.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+            cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s;", (version,))
+            if cur.fetchone():
+                continue
+            cur.execute(sql)
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);", (version, name))
+            applied += 1
+            logging.info(f"Applied migration {version}: {name}")
+
+    logging.info(f"Database schema is up to date ({applied} migration(s) applied).")
+    return applied
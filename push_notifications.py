@@ -0,0 +1,245 @@
+import datetime
+import hmac
+import itertools
+import logging
+import os
+import secrets
+import threading
+import uuid
+
+import token_store
+from calendar_api import CHANNEL_FIELDS
+from executors import db_executor
+
+# ==============================================================================
+# 1. CONFIGURATION
+# ==============================================================================
+# Opt-in: Google only delivers to a public HTTPS address on a verified domain.
+PUSH_NOTIFICATIONS_ENABLED = os.environ.get('PUSH_NOTIFICATIONS_ENABLED', '0') == '1'
+NOTIFICATIONS_PATH = '/calendar/notifications'
+# Google caps events.watch channels at roughly a week.
+CHANNEL_TTL_SECONDS = int(os.environ.get('CHANNEL_TTL_SECONDS', str(7 * 24 * 3600)))
+CHANNEL_RENEW_WINDOW = int(os.environ.get('CHANNEL_RENEW_WINDOW', str(24 * 3600)))
+CHANNEL_RENEW_INTERVAL = int(os.environ.get('CHANNEL_RENEW_INTERVAL', '3600'))
+CHANNEL_RENEW_BATCH_SIZE = int(os.environ.get('CHANNEL_RENEW_BATCH_SIZE', '100'))
+
+# ==============================================================================
+# 2. CHANNEL REGISTRATION AND RENEWAL
+# ==============================================================================
+class ChannelManager:
+    """Registers one events.watch channel per connected user and turns incoming
+    notifications into event-cache invalidations.
+
+    store holds the channel rows (token_store, or a LocalChannelStore offline)
+    and notify(user_id) tells other processes a user's calendar changed."""
+
+    def __init__(self, backend, event_cache, address, store=token_store, notify=token_store.notify_calendar_changed):
+        self.backend = backend
+        self.event_cache = event_cache
+        self.address = address
+        self.store = store
+        self.notify = notify
+        # channel_id -> (user_id, token); notifications arrive on Flask threads.
+        self._channels = {}
+        self._expirations = {}
+        self._lock = threading.Lock()
+        self.notifications = 0
+        self.rejected = 0
+
+    def _remember(self, user_id, channel_id, token, expiration):
+        with self._lock:
+            self._channels[channel_id] = (user_id, token)
+            self._expirations[user_id] = expiration
+
+    async def ensure_channel(self, user_id, creds):
+        user_id = int(user_id)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        renew_before = now + datetime.timedelta(seconds=CHANNEL_RENEW_WINDOW)
+        expiration = self._expirations.get(user_id)
+        if expiration is not None and expiration > renew_before:
+            self.event_cache.set_push_active(user_id, True)
+            return
+
+        existing = await db_executor.run(self.store.load_calendar_channel, user_id)
+        if existing:
+            channel_id, _, token, expiration = existing
+            if expiration > renew_before:
+                self._remember(user_id, channel_id, token, expiration)
+                self.event_cache.set_push_active(user_id, True)
+                return
+        await self._register(user_id, creds, existing)
+
+    async def _register(self, user_id, creds, existing=None):
+        channel_id = str(uuid.uuid4())
+        token = secrets.token_urlsafe(24)
+        body = {
+            'id': channel_id,
+            'type': 'web_hook',
+            'address': self.address,
+            'token': token,
+            'params': {'ttl': str(CHANNEL_TTL_SECONDS)},
+        }
+        result = await self.backend.watch_events(user_id, creds, 'primary', body, fields=CHANNEL_FIELDS)
+        expiration = datetime.datetime.fromtimestamp(int(result['expiration']) / 1000, datetime.timezone.utc)
+        await db_executor.run(
+            self.store.save_calendar_channel, user_id, channel_id, result['resourceId'], token, expiration
+        )
+        self._remember(user_id, channel_id, token, expiration)
+        self.event_cache.set_push_active(user_id, True)
+        logging.info(f"Registered calendar push channel for user {user_id} until {expiration}.")
+
+        if existing:
+            # The old channel overlaps the new one until it's stopped.
+            old_channel_id, old_resource_id = existing[0], existing[1]
+            try:
+                await self.backend.stop_channel(user_id, creds, {'id': old_channel_id, 'resourceId': old_resource_id})
+            except Exception as e:
+                logging.warning(f"Could not stop old push channel for user {user_id}: {e}")
+            with self._lock:
+                self._channels.pop(old_channel_id, None)
+
+    async def renew_expiring(self, get_credentials):
+        user_ids = await db_executor.run(
+            self.store.find_expiring_channels, CHANNEL_RENEW_WINDOW, CHANNEL_RENEW_BATCH_SIZE
+        )
+        for user_id in user_ids:
+            try:
+                creds = await get_credentials(user_id)
+                if not creds:
+                    await db_executor.run(self.store.delete_calendar_channel, user_id)
+                    self.forget(user_id)
+                    continue
+                with self._lock:
+                    self._expirations.pop(user_id, None)
+                await self.ensure_channel(user_id, creds)
+            except Exception as e:
+                logging.error(f"Could not renew push channel for user {user_id}: {e}")
+
+    async def stop(self, user_id, creds):
+        # Stops the user's channel at Google before its row goes, e.g. when
+        # they reconnect; only the account that created it can stop it.
+        user_id = int(user_id)
+        existing = await db_executor.run(self.store.load_calendar_channel, user_id)
+        if existing and creds:
+            try:
+                await self.backend.stop_channel(user_id, creds, {'id': existing[0], 'resourceId': existing[1]})
+            except Exception as e:
+                logging.warning(f"Could not stop push channel for user {user_id}: {e}")
+        if existing:
+            await db_executor.run(self.store.delete_calendar_channel, user_id)
+        self.forget(user_id)
+
+    def forget(self, user_id):
+        user_id = int(user_id)
+        with self._lock:
+            self._expirations.pop(user_id, None)
+            for channel_id, (owner, _) in list(self._channels.items()):
+                if owner == user_id:
+                    del self._channels[channel_id]
+        self.event_cache.set_push_active(user_id, False)
+
+    # ==========================================================================
+    # 3. NOTIFICATION INGESTION (CALLED FROM THE FLASK ROUTE)
+    # ==========================================================================
+    def handle_notification(self, headers):
+        channel_id = headers.get('X-Goog-Channel-ID')
+        token = headers.get('X-Goog-Channel-Token') or ''
+        resource_state = headers.get('X-Goog-Resource-State')
+        if not channel_id:
+            return 400
+
+        with self._lock:
+            known = self._channels.get(channel_id)
+        if known is None:
+            # Registered by another process, or before a restart.
+            row = self.store.find_calendar_channel(channel_id)
+            if row:
+                known = (row[0], row[1])
+                with self._lock:
+                    self._channels[channel_id] = known
+        if known is None or not hmac.compare_digest(known[1].encode(), token.encode()):
+            self.rejected += 1
+            logging.warning(f"Ignoring push notification for unknown channel {channel_id}.")
+            return 404
+
+        self.notifications += 1
+        if resource_state == 'sync':
+            return 200  # Handshake sent when the channel is created.
+        self.event_cache.invalidate(known[0])
+        # Bot processes hold their own caches; tell them too.
+        self.notify(known[0])
+        return 200
+
+    def stats(self):
+        return {'channels': len(self._channels), 'notifications': self.notifications, 'rejected': self.rejected}
+
+# ==============================================================================
+# 4. LOCAL STAND-INS
+# ==============================================================================
+class LocalChannelStore:
+    """In-memory replacement for token_store's calendar_channels helpers."""
+
+    def __init__(self):
+        self.rows = {}
+
+    def save_calendar_channel(self, user_id, channel_id, resource_id, token, expiration):
+        self.rows[int(user_id)] = (channel_id, resource_id, token, expiration)
+
+    def load_calendar_channel(self, user_id):
+        return self.rows.get(int(user_id))
+
+    def find_calendar_channel(self, channel_id):
+        for user_id, (row_channel_id, _, token, _) in self.rows.items():
+            if row_channel_id == channel_id:
+                return user_id, token
+        return None
+
+    def find_expiring_channels(self, within_seconds, limit):
+        cutoff = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=within_seconds)
+        expiring = sorted((row[3], user_id) for user_id, row in self.rows.items() if row[3] < cutoff)
+        return [user_id for _, user_id in expiring[:limit]]
+
+    def delete_calendar_channel(self, user_id):
+        self.rows.pop(int(user_id), None)
+
+
+class LocalPushNotifier:
+    """Offline stand-in for Google's side of push notifications.
+
+    Pass it to ChannelManager as the backend and attach() the manager:
+    watch/stop calls are recorded instead of sent, and notify_change() hands
+    the manager the headers Google would POST to NOTIFICATIONS_PATH."""
+
+    def __init__(self):
+        self.channels = {}
+        self.handle_notification = None
+        self._message_numbers = itertools.count(1)
+
+    def attach(self, manager):
+        self.handle_notification = manager.handle_notification
+
+    async def watch_events(self, user_id, creds, calendar_id, body, fields=None):
+        resource_id = f"local-{calendar_id}-{user_id}"
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            seconds=int(body.get('params', {}).get('ttl', CHANNEL_TTL_SECONDS))
+        )
+        self.channels[int(user_id)] = dict(body, resourceId=resource_id)
+        return {'id': body['id'], 'resourceId': resource_id, 'expiration': str(int(expiration.timestamp() * 1000))}
+
+    async def stop_channel(self, user_id, creds, body):
+        channel = self.channels.get(int(user_id))
+        if channel and channel['id'] == body['id']:
+            del self.channels[int(user_id)]
+
+    def deliver(self, channel_id, token, resource_id, resource_state):
+        return self.handle_notification({
+            'X-Goog-Channel-ID': channel_id,
+            'X-Goog-Channel-Token': token,
+            'X-Goog-Resource-ID': resource_id,
+            'X-Goog-Resource-State': resource_state,
+            'X-Goog-Message-Number': str(next(self._message_numbers)),
+        })
+
+    def notify_change(self, user_id):
+        channel = self.channels[int(user_id)]
+        return self.deliver(channel['id'], channel.get('token', ''), channel['resourceId'], 'exists')
@@ -0,0 +1,89 @@
+import logging
+import os
+import time
+
+from discord.ext import commands
+
+# ==============================================================================
+# 1. SHARD CONFIGURATION
+# ==============================================================================
+# SHARD_COUNT unset  -> a plain single-connection commands.Bot
+# SHARD_COUNT=auto   -> AutoShardedBot using Discord's recommended shard count
+# SHARD_COUNT=N      -> AutoShardedBot with N shards in total; SHARD_IDS picks the
+#                       ones this process runs (e.g. "0-3" or "0,2,4"), which is
+#                       how launcher.py spreads shards over several processes
+SHARD_COUNT = os.environ.get('SHARD_COUNT')
+SHARD_IDS = os.environ.get('SHARD_IDS')
+
+
+def parse_shard_ids(spec):
+    shard_ids = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            shard_ids.extend(range(int(first), int(last) + 1))
+        else:
+            shard_ids.append(int(part))
+    return sorted(set(shard_ids))
+
+
+def create_bot(**options):
+    if not SHARD_COUNT:
+        return commands.Bot(**options)
+    if SHARD_COUNT == 'auto':
+        logging.info("Starting AutoShardedBot with Discord's recommended shard count.")
+        return commands.AutoShardedBot(**options)
+
+    shard_count = int(SHARD_COUNT)
+    shard_ids = parse_shard_ids(SHARD_IDS) if SHARD_IDS else None
+    if shard_ids and max(shard_ids) >= shard_count:
+        raise ValueError(f"SHARD_IDS {SHARD_IDS} is out of range for SHARD_COUNT={shard_count}")
+    logging.info(f"Starting AutoShardedBot with shards {shard_ids or 'all'} of {shard_count}.")
+    return commands.AutoShardedBot(shard_count=shard_count, shard_ids=shard_ids, **options)
+
+
+def owns_primary_shard(bot):
+    # Chores that act on shared state (token refresh, push channel renewal)
+    # run once per deployment, in the process that owns shard 0.
+    shard_ids = getattr(bot, 'shard_ids', None)
+    return not shard_ids or 0 in shard_ids
+
+# ==============================================================================
+# 2. PER-SHARD METRICS
+# ==============================================================================
+def _gateway_sequences(bot):
+    # The gateway sequence number goes up by one per dispatched event, so its
+    # delta between samples is the shard's event rate at zero per-event cost.
+    if isinstance(bot, commands.AutoShardedBot):
+        for shard_id, shard in bot.shards.items():
+            ws = getattr(shard._parent, 'ws', None)
+            yield shard_id, shard.latency, getattr(ws, 'sequence', None)
+    else:
+        yield 0, bot.latency, getattr(bot.ws, 'sequence', None)
+
+
+class ShardMetrics:
+    def __init__(self):
+        self.shards = {}
+        self._previous = {}
+
+    def sample(self, bot):
+        now = time.monotonic()
+        for shard_id, latency, sequence in _gateway_sequences(bot):
+            rate = None
+            previous = self._previous.get(shard_id)
+            if previous and sequence is not None and previous[1] is not None and sequence >= previous[1]:
+                rate = (sequence - previous[1]) / (now - previous[0])
+            # A smaller sequence means a fresh session; the next sample has a rate again.
+            self._previous[shard_id] = (now, sequence)
+            self.shards[shard_id] = {
+                'latency': latency,
+                'events_per_second': rate,
+            }
+        return self.shards
+
+
+shard_metrics = ShardMetrics()
@@ -0,0 +1,83 @@
+import asyncio
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one execution.
+
+    The first caller for a key runs the function; callers that arrive while it
+    is in flight block until it finishes and receive the same result (or the
+    same exception)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executions += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        return {'executions': self.executions, 'coalesced': self.coalesced}
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines on one event loop: callers that arrive while
+    a key is in flight await the leader's result instead of blocking a thread."""
+
+    def __init__(self):
+        self._calls = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    async def do(self, key, func):
+        call = self._calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+            # shield() so one follower being cancelled doesn't cancel the leader.
+            return await asyncio.shield(call)
+
+        self.executions += 1
+        call = self._calls[key] = asyncio.ensure_future(func())
+        try:
+            return await asyncio.shield(call)
+        finally:
+            if call.done():
+                del self._calls[key]
+            else:
+                call.add_done_callback(lambda _: self._calls.pop(key, None))
+
+    def stats(self):
+        return {'executions': self.executions, 'coalesced': self.coalesced}
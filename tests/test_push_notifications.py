@@ -0,0 +1,61 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import push_notifications  # noqa: E402
+
+
+class RecordingEventCache:
+    def __init__(self):
+        self.invalidated = []
+        self.push_active = {}
+
+    def invalidate(self, user_id):
+        self.invalidated.append(user_id)
+
+    def set_push_active(self, user_id, active):
+        self.push_active[user_id] = active
+
+
+def make_manager():
+    notifier = push_notifications.LocalPushNotifier()
+    event_cache = RecordingEventCache()
+    notified = []
+    manager = push_notifications.ChannelManager(
+        notifier, event_cache, 'https://bot.example.com/calendar/notifications',
+        store=push_notifications.LocalChannelStore(), notify=notified.append,
+    )
+    notifier.attach(manager)
+    return manager, notifier, event_cache, notified
+
+
+def test_notification_invalidates_the_users_events():
+    manager, notifier, event_cache, notified = make_manager()
+    asyncio.run(manager.ensure_channel(42, creds=None))
+
+    assert notifier.notify_change(42) == 200
+    assert event_cache.invalidated == [42]
+    assert notified == [42]
+    assert event_cache.push_active == {42: True}
+
+
+def test_notification_with_wrong_token_is_rejected():
+    manager, notifier, event_cache, _ = make_manager()
+    asyncio.run(manager.ensure_channel(42, creds=None))
+    channel = notifier.channels[42]
+
+    assert notifier.deliver(channel['id'], 'not-the-token', channel['resourceId'], 'exists') == 404
+    assert event_cache.invalidated == []
+
+
+def test_stop_removes_the_channel():
+    manager, notifier, event_cache, _ = make_manager()
+    asyncio.run(manager.ensure_channel(42, creds=None))
+    channel = notifier.channels[42]
+    asyncio.run(manager.stop(42, creds=object()))
+
+    assert 42 not in notifier.channels
+    assert manager.store.load_calendar_channel(42) is None
+    assert notifier.deliver(channel['id'], channel['token'], channel['resourceId'], 'exists') == 404
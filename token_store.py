@@ -0,0 +1,476 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from psycopg2 import pool
+from psycopg2.extras import execute_values
+
+from executors import db_executor
+from invalidation import APPLICATION_NAME, CALENDAR_CHANNEL, calendar_change_payload
+
+# ==============================================================================
+# 1. POOL CONFIGURATION
+# ==============================================================================
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Bounded psycopg2 pool. Callers wait up to `timeout` seconds for a free
+    connection instead of failing immediately when the pool is exhausted."""
+
+    def __init__(self, dsn, min_size, max_size, timeout):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self._pool = None
+        self._init_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.in_use = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _get_pool(self):
+        # Connect lazily so importing the app never touches the database.
+        if self._pool is None:
+            with self._init_lock:
+                if self._pool is None:
+                    self._pool = pool.ThreadedConnectionPool(
+                        self.min_size, self.max_size, self.dsn, application_name=APPLICATION_NAME
+                    )
+                    logging.info(f"Database pool created (min={self.min_size}, max={self.max_size}).")
+        return self._pool
+
+    @contextmanager
+    def connection(self):
+        started = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._stats_lock:
+                self.timeouts += 1
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+        waited = time.perf_counter() - started
+        with self._stats_lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+        conn = None
+        try:
+            db_pool = self._get_pool()
+            conn = db_pool.getconn()
+            yield conn
+            conn.commit()
+        except Exception:
+            if conn is not None and not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            if conn is not None:
+                # Broken connections are discarded rather than handed to the next caller.
+                db_pool.putconn(conn, close=bool(conn.closed))
+            with self._stats_lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'size_max': self.max_size,
+                'in_use': self.in_use,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': self.wait_seconds_total,
+                'wait_seconds_max': self.wait_seconds_max,
+            }
+
+    def close(self):
+        with self._init_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+
+_db_pool = None
+
+
+def configure_token_store(dsn, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE, timeout=DB_POOL_TIMEOUT):
+    global _db_pool
+    _db_pool = ConnectionPool(dsn, min_size, max_size, timeout)
+    return _db_pool
+
+
+def connection():
+    if _db_pool is None:
+        raise RuntimeError("Token store is not configured; call configure_token_store() first.")
+    return _db_pool.connection()
+
+
+def pool_stats():
+    return _db_pool.stats() if _db_pool else {}
+
+
+def close_token_store():
+    write_behind.stop()
+    flush_user_activity()
+    if _db_pool is not None:
+        _db_pool.close()
+
+# ==============================================================================
+# 2. TOKEN QUERIES (SYNC - USED BY FLASK ROUTES AND WORKER THREADS)
+# ==============================================================================
+_token_listeners = []
+
+
+def add_token_listener(callback):
+    # Called with the user ID after every committed save or delete.
+    _token_listeners.append(callback)
+
+
+def _notify_token_changed(user_id):
+    for callback in _token_listeners:
+        callback(user_id)
+
+
+def _token_columns(token_json):
+    # Expiry and scopes are kept in their own indexed columns so scans over
+    # google_tokens never have to look inside the payload.
+    info = json.loads(token_json)
+    return info.get('expiry'), info.get('scopes')
+
+
+def load_user_token(user_id):
+    pending = write_behind.pending_token(user_id)
+    if pending is not None:
+        return pending
+    with connection() as conn, conn.cursor() as cur:
+        # The payload is stored as JSONB; callers still get the JSON text.
+        cur.execute("SELECT token_json::text FROM google_tokens WHERE user_id = %s;", (user_id,))
+        result = cur.fetchone()
+    return result[0] if result else None
+
+
+def save_user_token(user_id, token_json):
+    # A refresh of the previous grant must not land on top of this one.
+    write_behind.discard(user_id)
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO google_tokens (user_id, token_json, expiry, scopes) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (user_id) DO UPDATE
+            SET token_json = EXCLUDED.token_json, expiry = EXCLUDED.expiry, scopes = EXCLUDED.scopes;
+        """, (user_id, token_json, *_token_columns(token_json)))
+    _notify_token_changed(user_id)
+    logging.info(f"Successfully saved token for user {user_id}")
+
+
+def save_user_tokens(tokens, notify_listeners=True):
+    # Batched upsert of (user_id, token_json) pairs in a single statement.
+    rows = [(user_id, token_json, *_token_columns(token_json)) for user_id, token_json in tokens]
+    with connection() as conn, conn.cursor() as cur:
+        execute_values(cur, """
+            INSERT INTO google_tokens (user_id, token_json, expiry, scopes) VALUES %s
+            ON CONFLICT (user_id) DO UPDATE
+            SET token_json = EXCLUDED.token_json, expiry = EXCLUDED.expiry, scopes = EXCLUDED.scopes;
+        """, rows, template="(%s, %s::jsonb, %s::timestamptz, %s::text[])")
+    if notify_listeners:
+        for user_id, _ in tokens:
+            _notify_token_changed(user_id)
+    logging.info(f"Successfully saved {len(rows)} token(s) in one batch")
+
+
+def update_refreshed_tokens(tokens, notify_listeners=True):
+    # Unlike save_user_tokens this never inserts, and only touches rows still
+    # holding the same grant, so a token deleted or replaced (by any process)
+    # after it was refreshed stays deleted or replaced. Returns the user IDs
+    # that were actually updated.
+    rows = [(user_id, token_json, *_token_columns(token_json)) for user_id, token_json in tokens]
+    if not rows:
+        return []
+    with connection() as conn, conn.cursor() as cur:
+        updated = execute_values(cur, """
+            UPDATE google_tokens
+            SET token_json = refreshed.token_json, expiry = refreshed.expiry, scopes = refreshed.scopes
+            FROM (VALUES %s) AS refreshed (user_id, token_json, expiry, scopes)
+            WHERE google_tokens.user_id = refreshed.user_id
+              AND google_tokens.token_json->>'refresh_token' = refreshed.token_json->>'refresh_token'
+            RETURNING google_tokens.user_id;
+        """, rows, template="(%s::bigint, %s::jsonb, %s::timestamptz, %s::text[])", fetch=True)
+    user_ids = [row[0] for row in updated]
+    if notify_listeners:
+        for user_id in user_ids:
+            _notify_token_changed(user_id)
+    return user_ids
+
+
+def find_expiring_tokens(within_seconds, limit, active_within_days):
+    # Users who haven't run a command for a while get refreshed on demand instead.
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT user_id, token_json::text FROM google_tokens
+            WHERE expiry < now() + make_interval(secs => %s)
+              AND last_used_at > now() - make_interval(days => %s)
+            ORDER BY expiry
+            LIMIT %s;
+        """, (within_seconds, active_within_days, limit))
+        return cur.fetchall()
+
+
+def find_recently_active_users(limit):
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT user_id, token_json::text FROM google_tokens
+            ORDER BY last_used_at DESC
+            LIMIT %s;
+        """, (limit,))
+        return cur.fetchall()
+
+
+_user_activity = {}
+_user_activity_lock = threading.Lock()
+
+
+def record_user_activity(user_id):
+    # Kept in memory and written by flush_user_activity(), so a command never
+    # waits on a write just to bump last_used_at.
+    with _user_activity_lock:
+        _user_activity[int(user_id)] = time.time()
+
+
+def flush_user_activity():
+    with _user_activity_lock:
+        if not _user_activity:
+            return 0
+        rows = list(_user_activity.items())
+        _user_activity.clear()
+    with connection() as conn, conn.cursor() as cur:
+        execute_values(cur, """
+            UPDATE google_tokens SET last_used_at = to_timestamp(seen.used_at)
+            FROM (VALUES %s) AS seen (user_id, used_at)
+            WHERE google_tokens.user_id = seen.user_id AND google_tokens.last_used_at < to_timestamp(seen.used_at);
+        """, rows, template="(%s::bigint, %s::double precision)")
+    return len(rows)
+
+
+def delete_user_token(user_id):
+    write_behind.discard(user_id)
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM google_tokens WHERE user_id = %s;", (user_id,))
+    _notify_token_changed(user_id)
+
+
+def load_event_sync_state(user_id):
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT sync_token, events FROM event_sync_state WHERE user_id = %s;", (user_id,))
+        return cur.fetchone()
+
+
+def save_event_sync_state(user_id, sync_token, events_json):
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO event_sync_state (user_id, sync_token, events, updated_at) VALUES (%s, %s, %s, now())
+            ON CONFLICT (user_id) DO UPDATE
+            SET sync_token = EXCLUDED.sync_token, events = EXCLUDED.events, updated_at = EXCLUDED.updated_at;
+        """, (user_id, sync_token, events_json))
+
+
+def delete_event_sync_state(user_id):
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM event_sync_state WHERE user_id = %s;", (user_id,))
+
+
+def save_calendar_channel(user_id, channel_id, resource_id, token, expiration):
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO calendar_channels (user_id, channel_id, resource_id, token, expiration) VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (user_id) DO UPDATE
+            SET channel_id = EXCLUDED.channel_id, resource_id = EXCLUDED.resource_id,
+                token = EXCLUDED.token, expiration = EXCLUDED.expiration;
+        """, (user_id, channel_id, resource_id, token, expiration))
+
+
+def load_calendar_channel(user_id):
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "SELECT channel_id, resource_id, token, expiration FROM calendar_channels WHERE user_id = %s;",
+            (user_id,)
+        )
+        return cur.fetchone()
+
+
+def find_calendar_channel(channel_id):
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT user_id, token FROM calendar_channels WHERE channel_id = %s;", (channel_id,))
+        return cur.fetchone()
+
+
+def find_expiring_channels(within_seconds, limit):
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT user_id FROM calendar_channels
+            WHERE expiration < now() + make_interval(secs => %s)
+            ORDER BY expiration
+            LIMIT %s;
+        """, (within_seconds, limit))
+        return [row[0] for row in cur.fetchall()]
+
+
+def delete_calendar_channel(user_id):
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM calendar_channels WHERE user_id = %s;", (user_id,))
+
+
+def get_bot_state(key):
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT value FROM bot_state WHERE key = %s;", (key,))
+        result = cur.fetchone()
+    return result[0] if result else None
+
+
+def set_bot_state(key, value):
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO bot_state (key, value, updated_at) VALUES (%s, %s, now())
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at;
+        """, (key, value))
+
+
+def notify_calendar_changed(user_id):
+    # Lets every other process mark the user's cached events stale.
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT pg_notify(%s, %s);", (CALENDAR_CHANNEL, calendar_change_payload(user_id)))
+
+# ==============================================================================
+# 3. WRITE-BEHIND FOR REFRESHED TOKENS
+# ==============================================================================
+# sync:         every refreshed token is upserted before the command continues
+# write_behind: refreshed tokens are queued, coalesced per user and flushed in
+#               batches; the in-memory credentials stay authoritative meanwhile.
+#               A crash loses at most TOKEN_FLUSH_INTERVAL seconds of refreshes,
+#               which only costs those users one extra refresh later.
+TOKEN_WRITE_MODE = os.environ.get('TOKEN_WRITE_MODE', 'sync')
+TOKEN_FLUSH_INTERVAL = float(os.environ.get('TOKEN_FLUSH_INTERVAL', '2'))
+TOKEN_FLUSH_BATCH_SIZE = int(os.environ.get('TOKEN_FLUSH_BATCH_SIZE', '500'))
+
+
+class WriteBehindQueue:
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.enqueued = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.rows_written = 0
+
+    def enqueue(self, user_id, token_json):
+        user_id = int(user_id)
+        with self._lock:
+            if user_id in self._pending:
+                self.coalesced += 1
+            self._pending[user_id] = token_json
+            self.enqueued += 1
+            size = len(self._pending)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='token-write-behind', daemon=True)
+                self._thread.start()
+        if size >= self.batch_size:
+            self._wake.set()
+
+    def pending_token(self, user_id):
+        with self._lock:
+            return self._pending.get(int(user_id))
+
+    def discard(self, user_id):
+        with self._lock:
+            self._pending.pop(int(user_id), None)
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        try:
+            written = len(update_refreshed_tokens(list(batch.items()), notify_listeners=False))
+        except Exception as e:
+            logging.error(f"Could not flush {len(batch)} queued token(s), will retry: {e}")
+            with self._lock:
+                # Anything queued meanwhile is newer than what failed.
+                for user_id, token_json in batch.items():
+                    self._pending.setdefault(user_id, token_json)
+            return 0
+        self.flushes += 1
+        self.rows_written += written
+        return written
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def stop(self):
+        # Final flush on shutdown so queued tokens aren't lost.
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        self.flush()
+
+    def stats(self):
+        return {
+            'mode': TOKEN_WRITE_MODE,
+            'pending': len(self._pending),
+            'enqueued': self.enqueued,
+            'coalesced': self.coalesced,
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+        }
+
+
+write_behind = WriteBehindQueue(TOKEN_FLUSH_INTERVAL, TOKEN_FLUSH_BATCH_SIZE)
+
+
+def save_refreshed_token(user_id, token_json):
+    if TOKEN_WRITE_MODE == 'write_behind':
+        write_behind.enqueue(user_id, token_json)
+    else:
+        update_refreshed_tokens([(user_id, token_json)])
+
+# ==============================================================================
+# 4. ASYNC FACADE (USED FROM THE DISCORD EVENT LOOP)
+# ==============================================================================
+# psycopg2 is a blocking driver, so each pooled checkout runs on the DB
+# executor and the event loop only awaits the result.
+async def load_user_token_async(user_id):
+    return await db_executor.run(load_user_token, user_id)
+
+
+async def save_user_token_async(user_id, token_json):
+    await db_executor.run(save_user_token, user_id, token_json)
+
+
+async def save_refreshed_token_async(user_id, token_json):
+    if TOKEN_WRITE_MODE == 'write_behind':
+        write_behind.enqueue(user_id, token_json)
+    else:
+        await save_user_token_async(user_id, token_json)
+
+
+async def delete_user_token_async(user_id):
+    await db_executor.run(delete_user_token, user_id)